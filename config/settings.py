@@ -91,6 +91,19 @@ DATABASES = {
 }
 
 
+# Cache
+# The user, permission, customer and purchase history caches are invalidated
+# by signals, so every web and worker process must share one cache.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'KEY_PREFIX': 'store_drf',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -138,7 +151,7 @@ REST_FRAMEWORK = {
     # 'PAGE_SIZE': 10,
     # 'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.StatelessJWTAuthentication',
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
@@ -148,6 +161,7 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('JWT', ),
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
+    'TOKEN_OBTAIN_SERIALIZER': 'core.serializers.TokenObtainPairSerializer',
 }
 
 # Djoser config
@@ -171,7 +185,24 @@ SPECTACULAR_SETTINGS = {
 
 AUTH_USER_MODEL = 'core.CustomUser'
 
+AUTHENTICATION_BACKENDS = [
+    'core.backends.CachedModelBackend',
+]
+
 
 # ZarinPal
 SANDBOX = True
-ZARINPALL_MERCHANT_ID = 'aaabbbaaabbbaaabbbaaabbbaaabbbaaabbb'
\ No newline at end of file
+ZARINPALL_MERCHANT_ID = 'aaabbbaaabbbaaabbbaaabbbaaabbbaaabbb'
+# How long the signed state in a payment callback URL stays valid
+ZARINPAL_CALLBACK_MAX_AGE = timedelta(hours=1)
+
+# Idempotency-Key support for order creation and payment
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# A request still unanswered after this is taken to have died with its worker
+IDEMPOTENCY_KEY_LEASE = timedelta(minutes=5)
+
+# Unpaid orders older than this are canceled by expire_unpaid_orders
+UNPAID_ORDER_TTL = timedelta(days=1)
+
+# Paid and canceled orders older than this are moved by archive_orders
+ORDER_ARCHIVE_AFTER = timedelta(days=365)
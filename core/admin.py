@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
-from .models import CustomUser
+from .models import CustomUser, Task
 
 
 @admin.register(CustomUser)
@@ -22,3 +22,12 @@ class CustomUserAdmin(UserAdmin):
             },
         ),
     )
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'status', 'attempts', 'visible_at', 'datetime_created', 'datetime_finished']
+    list_filter = ['status', 'name']
+    search_fields = ['=id', 'name']
+    readonly_fields = ['datetime_created', 'datetime_started', 'datetime_finished']
+    ordering = ['-id']
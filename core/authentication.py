@@ -0,0 +1,91 @@
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import get_cached_user
+
+CUSTOMER_ID_CLAIM = 'customer_id'
+CLAIMS = [CUSTOMER_ID_CLAIM]
+
+
+class ClaimsUser(TokenUser):
+    """
+    A user built from the token claims.
+
+    id and customer_id come from the token. is_active, is_staff, permission
+    checks and any other attribute are read from the real user, kept in a
+    short-lived cache, so deactivating or demoting a user is not delayed
+    until their tokens expire.
+    """
+    def __str__(self):
+        return f'ClaimsUser {self.id}'
+
+    @cached_property
+    def db_user(self):
+        return get_cached_user(self.id)
+
+    @cached_property
+    def customer_id(self):
+        return self.token[CUSTOMER_ID_CLAIM]
+
+    @cached_property
+    def is_active(self):
+        return self.db_user.is_active
+
+    @cached_property
+    def is_staff(self):
+        return self.db_user.is_staff
+
+    @cached_property
+    def username(self):
+        return self.db_user.username
+
+    @cached_property
+    def is_superuser(self):
+        return self.db_user.is_superuser
+
+    def get_group_permissions(self, obj=None):
+        return self.db_user.get_group_permissions(obj)
+
+    def get_all_permissions(self, obj=None):
+        return self.db_user.get_all_permissions(obj)
+
+    def has_perm(self, perm, obj=None):
+        return self.db_user.has_perm(perm, obj)
+
+    def has_perms(self, perm_list, obj=None):
+        return self.db_user.has_perms(perm_list, obj)
+
+    def has_module_perms(self, module):
+        return self.db_user.has_module_perms(module)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.db_user, attr)
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that trusts the token claims instead of loading the
+    user on every request.
+
+    Tokens issued before the claims were added are still authenticated
+    against the database.
+    """
+    def get_user(self, validated_token):
+        if not all(claim in validated_token for claim in CLAIMS):
+            return super().get_user(validated_token)
+
+        user = ClaimsUser(validated_token)
+        try:
+            user.db_user
+        except self.user_model.DoesNotExist as e:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found") from e
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        return user
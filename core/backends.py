@@ -0,0 +1,22 @@
+from django.contrib.auth.backends import ModelBackend
+
+from .cache import get_cached_permissions, set_cached_permissions
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend keeping each user's permission set in the cache, so
+    has_perm() checks cost no queries once a user's permissions are cached.
+
+    core.signals drops the cached sets when permissions or groups change.
+    """
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            permissions = get_cached_permissions(user_obj.pk)
+            if permissions is None:
+                permissions = super().get_all_permissions(user_obj)
+                set_cached_permissions(user_obj.pk, permissions)
+            user_obj._perm_cache = permissions
+        return user_obj._perm_cache
@@ -0,0 +1,47 @@
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+USER_TIMEOUT = 60
+PERMISSIONS_TIMEOUT = 60 * 60
+_PERMISSIONS_VERSION_KEY = 'core:perms:version'
+
+
+def _user_key(user_id):
+    return f'core:user:{user_id}'
+
+
+def get_cached_user(user_id):
+    key = _user_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        user = get_user_model().objects.get(pk=user_id)
+        cache.set(key, user, USER_TIMEOUT)
+    return user
+
+
+def invalidate_cached_user(user_id):
+    cache.delete(_user_key(user_id))
+
+
+def _permissions_key(user_id):
+    version = cache.get_or_set(_PERMISSIONS_VERSION_KEY, uuid4().hex, timeout=None)
+    return f'core:perms:{version}:{user_id}'
+
+
+def get_cached_permissions(user_id):
+    return cache.get(_permissions_key(user_id))
+
+
+def set_cached_permissions(user_id, permissions):
+    cache.set(_permissions_key(user_id), permissions, PERMISSIONS_TIMEOUT)
+
+
+def invalidate_cached_permissions(*user_ids):
+    cache.delete_many([_permissions_key(user_id) for user_id in user_ids])
+
+
+def invalidate_all_cached_permissions():
+    # Moving the version orphans the cached permissions of every user.
+    cache.set(_PERMISSIONS_VERSION_KEY, uuid4().hex, timeout=None)
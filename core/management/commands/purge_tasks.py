@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import Task
+
+
+class Command(BaseCommand):
+    help = "Deletes finished background tasks older than --days"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7)
+
+    def handle(self, *args, **options):
+        deleted_count, _ = Task.objects.filter(
+            status__in=[Task.TASK_STATUS_DONE, Task.TASK_STATUS_FAILED],
+            datetime_finished__lt=timezone.now() - timedelta(days=options['days']),
+            ).delete()
+        self.stdout.write(f"Deleted {deleted_count} finished tasks.")
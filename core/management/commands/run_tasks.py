@@ -0,0 +1,36 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from core.tasks import VISIBILITY_TIMEOUT, run_tasks
+
+
+class Command(BaseCommand):
+    help = "Runs queued background tasks; runs until stopped unless --once is given"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument(
+            '--visibility-timeout',
+            type=float,
+            default=VISIBILITY_TIMEOUT.total_seconds(),
+            help='Seconds before a task claimed by a dead worker is run again.',
+            )
+        parser.add_argument('--poll-interval', type=float, default=1, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--once', action='store_true', help='Exit when no task is due.')
+
+    def handle(self, *args, **options):
+        while True:
+            result = run_tasks(
+                batch_size=options['batch_size'],
+                visibility_timeout=timedelta(seconds=options['visibility_timeout']),
+                )
+            if result is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            done_count, failed_count = result
+            self.stdout.write(f"Ran {done_count} tasks, {failed_count} failed for good.")
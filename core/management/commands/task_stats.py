@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.tasks import queue_stats
+
+
+class Command(BaseCommand):
+    help = "Shows queue depth and latency of background tasks per task name"
+
+    def handle(self, *args, **options):
+        for row in queue_stats():
+            self.stdout.write(
+                f"{row['name']}: {row['queued']} queued, {row['running']} running, {row['failed']} failed, "
+                f"{row['done']} done in the last hour; oldest due task waiting {row['oldest_due_age'] or '-'}, "
+                f"average wait {row['average_wait'] or '-'}, average run {row['average_run'] or '-'}"
+                )
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_customuser_name_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('q', 'Queued'), ('r', 'Running'), ('d', 'Done'), ('f', 'Failed')], default='q', max_length=1)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('max_attempts', models.PositiveSmallIntegerField(default=5)),
+                ('last_error', models.TextField(blank=True)),
+                ('visible_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('datetime_created', models.DateTimeField(auto_now_add=True)),
+                ('datetime_started', models.DateTimeField(blank=True, null=True)),
+                ('datetime_finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'visible_at'], name='core_task_status_8b56b3_idx'), models.Index(fields=['status', 'datetime_finished'], name='core_task_status_452fff_idx')],
+            },
+        ),
+    ]
@@ -1,6 +1,50 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 
 class CustomUser(AbstractUser):
     email = models.EmailField(unique=True, max_length=254, verbose_name='email address')
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # prefix search and ordering in the customer directory
+            models.Index(fields=['last_name', 'first_name']),
+            models.Index(fields=['first_name']),
+        ]
+
+
+class Task(models.Model):
+    TASK_STATUS_QUEUED = 'q'
+    TASK_STATUS_RUNNING = 'r'
+    TASK_STATUS_DONE = 'd'
+    TASK_STATUS_FAILED = 'f'
+
+    TASK_STATUS = [
+        (TASK_STATUS_QUEUED, 'Queued'),
+        (TASK_STATUS_RUNNING, 'Running'),
+        (TASK_STATUS_DONE, 'Done'),
+        (TASK_STATUS_FAILED, 'Failed'),
+    ]
+
+    # name of a handler registered with core.tasks.task
+    name = models.CharField(max_length=255)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=1, choices=TASK_STATUS, default=TASK_STATUS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    last_error = models.TextField(blank=True)
+    # A running task whose worker died is picked up again once this passes.
+    visible_at = models.DateTimeField(default=timezone.now)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+    datetime_started = models.DateTimeField(null=True, blank=True)
+    datetime_finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'visible_at']),
+            models.Index(fields=['status', 'datetime_finished']),
+        ]
+
+    def __str__(self):
+        return f'{self.name} #{self.id}'
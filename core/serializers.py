@@ -1,5 +1,10 @@
 from djoser.serializers import UserCreateSerializer as DjoserUserCreateSerializer
 from djoser.serializers import UserSerializer as DjoserUserSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer as SimpleJWTTokenObtainPairSerializer
+
+from store.models import Customer
+
+from .authentication import CUSTOMER_ID_CLAIM
 
 class UserCreateSerializer(DjoserUserCreateSerializer):
     class Meta(DjoserUserCreateSerializer.Meta):
@@ -22,3 +27,13 @@ class UserSerializer(DjoserUserSerializer):
             'first_name',
             'last_name'
             ]
+
+
+class TokenObtainPairSerializer(SimpleJWTTokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        # Refreshed access tokens copy this claim. It never changes for a user,
+        # unlike is_staff, which StatelessJWTAuthentication reads from the cached user.
+        token = super().get_token(user)
+        token[CUSTOMER_ID_CLAIM] = Customer.objects.values_list('id', flat=True).filter(user_id=user.id).first()
+        return token
@@ -1,8 +1,49 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 
 from store.signals import order_created
 
+from .cache import invalidate_all_cached_permissions, invalidate_cached_permissions, invalidate_cached_user
+from .tasks import enqueue, task
+
+
+@task('core.after_order_created')
+def after_order_created(order_id):
+    print(f"New order is created {order_id}")
+
 
 @receiver(order_created)
-def after_order_created(sender, **kwargs):
-    print(f"New order is created {kwargs['order'].id}")
+def enqueue_after_order_created(sender, **kwargs):
+    # Runs in a run_tasks worker instead of the checkout request.
+    enqueue('core.after_order_created', order_id=kwargs['order'].id)
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user_on_change(sender, instance, **kwargs):
+    invalidate_cached_user(instance.id)
+    # is_active and is_superuser change the permission set too.
+    invalidate_cached_permissions(instance.id)
+
+
+@receiver(m2m_changed)
+def invalidate_cached_permissions_on_change(sender, instance, action, reverse, **kwargs):
+    if not action.startswith('post_'):
+        return
+
+    from django.contrib.auth.models import Group
+
+    user_model = get_user_model()
+    if sender in [user_model.user_permissions.through, user_model.groups.through] and not reverse:
+        invalidate_cached_permissions(instance.pk)
+    elif sender in [user_model.user_permissions.through, user_model.groups.through, Group.permissions.through]:
+        # A permission or group changed for possibly many users.
+        invalidate_all_cached_permissions()
+
+
+@receiver(post_delete, sender='auth.Group')
+@receiver(post_delete, sender='auth.Permission')
+def invalidate_all_cached_permissions_on_delete(sender, **kwargs):
+    # Their user and group links are deleted without m2m_changed.
+    invalidate_all_cached_permissions()
@@ -0,0 +1,141 @@
+"""
+A small database-backed task queue.
+
+    @task('store.send_receipt')
+    def send_receipt(order_id): ...
+
+    enqueue('store.send_receipt', order_id=order.id)
+
+Tasks are run by `python manage.py run_tasks` worker processes.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Avg, Count, F, Min, Q
+from django.utils import timezone
+
+VISIBILITY_TIMEOUT = timedelta(minutes=5)
+RETRY_BACKOFF = timedelta(seconds=10)
+
+_handlers = {}
+
+
+def task(name):
+    """Register the decorated function as the handler of tasks called `name`."""
+    def decorator(handler):
+        _handlers[name] = handler
+        return handler
+    return decorator
+
+
+# core.signals registers handlers while the app registry is still loading,
+# so the Task model is imported inside the functions below.
+
+def enqueue(name, max_attempts=5, **payload):
+    from .models import Task
+
+    if name not in _handlers:
+        raise KeyError(f'No task handler is registered as {name!r}.')
+    return Task.objects.create(name=name, payload=payload, max_attempts=max_attempts)
+
+
+def _claim(batch_size, visibility_timeout):
+    from .models import Task
+
+    now = timezone.now()
+    with transaction.atomic():
+        due = list(
+            Task.objects
+            .select_for_update(skip_locked=True)
+            .filter(status__in=[Task.TASK_STATUS_QUEUED, Task.TASK_STATUS_RUNNING], visible_at__lte=now)
+            .order_by('visible_at')
+            .values_list('id', 'attempts', 'max_attempts')[:batch_size]
+            )
+        task_ids = []
+        exhausted_ids = []
+        for task_id, attempts, max_attempts in due:
+            # Claimed max_attempts times by workers that died before finishing it.
+            (exhausted_ids if attempts >= max_attempts else task_ids).append(task_id)
+        Task.objects.filter(id__in=exhausted_ids).update(
+            status=Task.TASK_STATUS_FAILED,
+            last_error='Visibility timeout expired',
+            datetime_finished=now,
+            )
+        Task.objects.filter(id__in=task_ids).update(
+            status=Task.TASK_STATUS_RUNNING,
+            attempts=F('attempts') + 1,
+            visible_at=now + visibility_timeout,
+            datetime_started=now,
+            )
+    return list(Task.objects.filter(id__in=task_ids).order_by('visible_at', 'id')), len(exhausted_ids)
+
+
+def run_tasks(batch_size=100, visibility_timeout=VISIBILITY_TIMEOUT):
+    """
+    Claim and run one batch of due tasks.
+
+    A claimed task stays invisible to other workers for
+    `visibility_timeout`; if this worker dies meanwhile it is claimed again
+    afterwards, so handlers must be safe to run twice. Failed tasks are
+    retried with exponential backoff up to their max_attempts, and a task
+    claimed max_attempts times by dying workers is marked failed. Returns
+    (done, failed) counts, or None when nothing was due.
+    """
+    from .models import Task
+
+    tasks, failed_count = _claim(batch_size, visibility_timeout)
+    if not tasks and not failed_count:
+        return None
+
+    done_ids = []
+    for claimed_task in tasks:
+        try:
+            with transaction.atomic():
+                _handlers[claimed_task.name](**claimed_task.payload)
+        except Exception as e:
+            failed = claimed_task.attempts >= claimed_task.max_attempts
+            failed_count += failed
+            Task.objects.filter(id=claimed_task.id).update(
+                status=Task.TASK_STATUS_FAILED if failed else Task.TASK_STATUS_QUEUED,
+                last_error=f'{type(e).__name__}: {e}',
+                visible_at=timezone.now() + RETRY_BACKOFF * 2 ** (claimed_task.attempts - 1),
+                datetime_finished=timezone.now() if failed else None,
+                )
+        else:
+            done_ids.append(claimed_task.id)
+
+    Task.objects.filter(id__in=done_ids).update(status=Task.TASK_STATUS_DONE, datetime_finished=timezone.now())
+    return len(done_ids), failed_count
+
+
+def queue_stats(since=None):
+    """
+    Per task name: queued, running and failed counts, the age of the oldest
+    due task, and the average wait and run time of tasks finished since
+    `since` (the last hour by default).
+    """
+    from .models import Task
+
+    now = timezone.now()
+    since = since or now - timedelta(hours=1)
+    finished = Q(status=Task.TASK_STATUS_DONE, datetime_finished__gte=since)
+    rows = Task.objects\
+        .filter(Q(status__in=[Task.TASK_STATUS_QUEUED, Task.TASK_STATUS_RUNNING, Task.TASK_STATUS_FAILED]) | finished)\
+        .values('name')\
+        .annotate(
+            queued=Count('id', filter=Q(status=Task.TASK_STATUS_QUEUED)),
+            running=Count('id', filter=Q(status=Task.TASK_STATUS_RUNNING)),
+            failed=Count('id', filter=Q(status=Task.TASK_STATUS_FAILED)),
+            done=Count('id', filter=finished),
+            oldest_due=Min('visible_at', filter=Q(status=Task.TASK_STATUS_QUEUED, visible_at__lte=now)),
+            average_wait=Avg(F('datetime_started') - F('datetime_created'), filter=finished),
+            average_run=Avg(F('datetime_finished') - F('datetime_started'), filter=finished),
+            )\
+        .order_by('name')
+
+    stats = []
+    for row in rows:
+        oldest_due = row.pop('oldest_due')
+        row['oldest_due_age'] = now - oldest_due if oldest_due else None
+        stats.append(row)
+    return stats
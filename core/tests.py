@@ -1,3 +1,215 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from store.factories import UserFactory
+
+from .models import Task
+from .tasks import enqueue, queue_stats, run_tasks, task
+
+calls = []
+
+
+@task('core.tests.record')
+def record(value, fail_times=0):
+    calls.append(value)
+    if calls.count(value) <= fail_times:
+        raise ValueError(f'failed {value}')
+
+
+class StatelessJWTAuthenticationTests(TestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory(username='customer')
+
+    def login(self):
+        response = self.client.post(
+            reverse('jwt-create'),
+            {'username': 'customer', 'password': 'secret-pass'},
+            format='json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.credentials(HTTP_AUTHORIZATION=f"JWT {response.data['access']}")
+        return AccessToken(response.data['access'])
+
+    def user_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response, [query['sql'] for query in queries if 'core_customuser' in query['sql'] and 'permission' not in query['sql']]
+
+    def test_token_claims_replace_the_user_query(self):
+        token = self.login()
+        self.assertNotIn('is_staff', token)
+        self.assertEqual(token['customer_id'], self.user.customer.id)
+
+        # the first request caches the user
+        self.client.get(reverse('store:order-list'))
+        response, user_queries = self.user_queries(reverse('store:order-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(user_queries, [])
+
+    def test_deactivated_users_are_rejected(self):
+        self.login()
+        self.assertEqual(self.client.get(reverse('store:order-list')).status_code, status.HTTP_200_OK)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('store:order-list')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_staff_status_is_read_from_the_user(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.login()
+        self.assertEqual(self.client.get(reverse('store:customer-list')).status_code, status.HTTP_200_OK)
+
+        self.user.is_staff = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('store:customer-list')).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_tokens_without_claims_load_the_user(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {AccessToken.for_user(self.user)}')
+
+        response, user_queries = self.user_queries(reverse('store:order-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(user_queries), 1)
+
+    def send_private_email(self, data=None):
+        url = reverse('store:customer-send-private-email', args=[self.user.customer.id])
+        return self.client.post(url, data or {'subject': 'Hello', 'body': 'Hi'}, format='json')
+
+    def test_permission_checks_are_cached(self):
+        self.login()
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.user_permissions.add(Permission.objects.get(codename='send_private_email'))
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_202_ACCEPTED)
+
+        # user and permissions both come from the cache; the invalid body
+        # stops the request right after the permission check
+        with self.assertNumQueries(0):
+            response = self.send_private_email({'subject': ''})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_group_permission_changes_reach_cached_permissions(self):
+        self.login()
+        group = Group.objects.create(name='support')
+        self.user.groups.add(group)
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_403_FORBIDDEN)
+
+        group.permissions.add(Permission.objects.get(codename='send_private_email'))
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_202_ACCEPTED)
+
+        self.user.groups.remove(group)
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_deleted_groups_and_permissions_leave_cached_permissions(self):
+        self.login()
+        group = Group.objects.create(name='support')
+        self.user.groups.add(group)
+        group.permissions.add(Permission.objects.get(codename='send_private_email'))
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_202_ACCEPTED)
+
+        group.delete()
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_403_FORBIDDEN)
+
+        permission = Permission.objects.get(codename='send_private_email')
+        self.user.user_permissions.add(permission)
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_202_ACCEPTED)
+
+        permission.delete()
+        self.assertEqual(self.send_private_email().status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_djoser_endpoints_use_the_database_user(self):
+        self.login()
+
+        response = self.client.patch(reverse('customuser-me'), {'first_name': 'Ali'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['username'], 'customer')
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, 'Ali')
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_enqueue_requires_a_registered_handler(self):
+        with self.assertRaises(KeyError):
+            enqueue('core.tests.missing')
+
+    def test_run_tasks_runs_due_tasks(self):
+        first = enqueue('core.tests.record', value='first')
+        second = enqueue('core.tests.record', value='second')
+
+        self.assertEqual(run_tasks(), (2, 0))
+        self.assertEqual(calls, ['first', 'second'])
+        self.assertIsNone(run_tasks())
+
+        for queued_task in [first, second]:
+            queued_task.refresh_from_db()
+            self.assertEqual(queued_task.status, Task.TASK_STATUS_DONE)
+            self.assertEqual(queued_task.attempts, 1)
+            self.assertIsNotNone(queued_task.datetime_finished)
+
+    def test_failed_tasks_are_retried_then_given_up(self):
+        queued_task = enqueue('core.tests.record', max_attempts=2, value='flaky', fail_times=5)
+
+        self.assertEqual(run_tasks(), (0, 0))
+        queued_task.refresh_from_db()
+        self.assertEqual(queued_task.status, Task.TASK_STATUS_QUEUED)
+        self.assertEqual(queued_task.last_error, 'ValueError: failed flaky')
+        # backing off
+        self.assertIsNone(run_tasks())
+
+        Task.objects.update(visible_at=timezone.now())
+        self.assertEqual(run_tasks(), (0, 1))
+        queued_task.refresh_from_db()
+        self.assertEqual(queued_task.status, Task.TASK_STATUS_FAILED)
+        self.assertEqual(queued_task.attempts, 2)
+        self.assertEqual(calls, ['flaky', 'flaky'])
+
+    def test_tasks_of_dead_workers_are_reclaimed(self):
+        queued_task = enqueue('core.tests.record', value='orphan')
+        # as left by a worker that died while running it
+        Task.objects.update(status=Task.TASK_STATUS_RUNNING, attempts=1, visible_at=timezone.now() + timedelta(minutes=5))
+        self.assertIsNone(run_tasks())
+
+        Task.objects.update(visible_at=timezone.now())
+        self.assertEqual(run_tasks(), (1, 0))
+        queued_task.refresh_from_db()
+        self.assertEqual(queued_task.status, Task.TASK_STATUS_DONE)
+        self.assertEqual(queued_task.attempts, 2)
+
+    def test_tasks_that_keep_killing_workers_are_given_up(self):
+        queued_task = enqueue('core.tests.record', max_attempts=2, value='poison')
+        Task.objects.update(status=Task.TASK_STATUS_RUNNING, attempts=2, visible_at=timezone.now())
+
+        self.assertEqual(run_tasks(), (0, 1))
+        queued_task.refresh_from_db()
+        self.assertEqual(queued_task.status, Task.TASK_STATUS_FAILED)
+        self.assertEqual(queued_task.attempts, 2)
+        self.assertIsNotNone(queued_task.datetime_finished)
+        self.assertEqual(calls, [])
+
+    def test_queue_stats(self):
+        enqueue('core.tests.record', value='done')
+        run_tasks()
+        enqueue('core.tests.record', value='waiting')
 
-# Create your tests here.
+        [row] = queue_stats()
+        self.assertEqual(row['name'], 'core.tests.record')
+        self.assertEqual((row['queued'], row['running'], row['failed'], row['done']), (1, 0, 0, 1))
+        self.assertGreaterEqual(row['oldest_due_age'], timedelta(0))
+        self.assertIsInstance(row['average_run'], timedelta)
@@ -0,0 +1,8 @@
+from rest_framework.routers import DefaultRouter
+
+from . import views
+
+router = DefaultRouter()
+router.register('users', views.UserViewSet)
+
+urlpatterns = router.urls
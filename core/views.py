@@ -1,3 +1,8 @@
-from django.shortcuts import render
+from djoser.views import UserViewSet as DjoserUserViewSet
+from rest_framework_simplejwt.authentication import JWTAuthentication
 
-# Create your views here.
+
+class UserViewSet(DjoserUserViewSet):
+    # djoser reads, edits and saves request.user itself, so it needs the
+    # database user rather than the one built from the token claims.
+    authentication_classes = [JWTAuthentication]
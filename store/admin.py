@@ -1,11 +1,14 @@
+from django import forms
 from django.contrib import admin, messages
-from django.db.models import Count
-from django.http.request import HttpRequest
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.http import urlencode
 
-from .models import Cart, CartItem, Category, Comment, Customer, Order, OrderItem, Product
+from .models import ArchivedOrder, ArchivedOrderItem, Cart, CartItem, Category, Comment, Customer, Order, OrderItem, PaymentAttempt, PrivateEmail, Product
+from .paginations import EstimatedCountPaginator
+from .signals import order_status_changed
 
 
 class InventoryFilter(admin.SimpleListFilter):
@@ -45,7 +48,11 @@ class ProductAdmin(admin.ModelAdmin):
     list_per_page = 10
     list_editable = ['unit_price']
     list_select_related = ['category']
-    list_filter = ['datetime_created', InventoryFilter]
+    list_filter = [InventoryFilter]
+    date_hierarchy = 'datetime_created'
+    # The catalog is too large to count on every page load.
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     actions = ['clear_inventory']
     prepopulated_fields = {
         'slug': ['name', ]
@@ -64,9 +71,16 @@ class ProductAdmin(admin.ModelAdmin):
         return product.category.title
 
     def get_queryset(self, request):
+        # A correlated subquery is only evaluated for the rows of the page and
+        # is dropped from the changelist count, unlike a GROUP BY over comments.
+        comments_count = Comment.objects \
+            .filter(product_id=OuterRef('id')) \
+            .order_by() \
+            .values('product_id') \
+            .annotate(count=Count('id')) \
+            .values('count')
         return super().get_queryset(request) \
-            .prefetch_related('comments') \
-            .annotate(comments_count=Count('comments'))
+            .annotate(comments_count=Coalesce(Subquery(comments_count), 0))
 
     @admin.display(ordering='comments_count', description='# comments')
     def num_of_comments(self, product: Product):
@@ -99,30 +113,184 @@ class OrderItemInline(admin.TabularInline):
     max_num = 10
 
 
+class OrderTotalPriceFilter(admin.SimpleListFilter):
+    LESS_THAN_100 = '<100'
+    BETWEEN_100_AND_1000 = '100<=1000'
+    MORE_THAN_1000 = '>1000'
+    title = 'Total Price'
+    parameter_name = 'total_price'
+
+    def lookups(self, request, model_admin):
+        return [
+            (OrderTotalPriceFilter.LESS_THAN_100, 'Under 100'),
+            (OrderTotalPriceFilter.BETWEEN_100_AND_1000, '100 to 1000'),
+            (OrderTotalPriceFilter.MORE_THAN_1000, 'Over 1000')
+        ]
+
+    def queryset(self, request, queryset):
+        if self.value() == OrderTotalPriceFilter.LESS_THAN_100:
+            return queryset.filter(total_price__lt=100)
+        if self.value() == OrderTotalPriceFilter.BETWEEN_100_AND_1000:
+            return queryset.filter(total_price__range=(100, 1000))
+        if self.value() == OrderTotalPriceFilter.MORE_THAN_1000:
+            return queryset.filter(total_price__gt=1000)
+
+
+class CustomerLifetimeSpendFilter(admin.SimpleListFilter):
+    NONE = '0'
+    LESS_THAN_100 = '<100'
+    BETWEEN_100_AND_1000 = '100<=1000'
+    MORE_THAN_1000 = '>1000'
+    title = 'Lifetime Spend'
+    parameter_name = 'lifetime_spend'
+
+    def lookups(self, request, model_admin):
+        return [
+            (CustomerLifetimeSpendFilter.NONE, 'No paid orders'),
+            (CustomerLifetimeSpendFilter.LESS_THAN_100, 'Under 100'),
+            (CustomerLifetimeSpendFilter.BETWEEN_100_AND_1000, '100 to 1000'),
+            (CustomerLifetimeSpendFilter.MORE_THAN_1000, 'Over 1000')
+        ]
+
+    def queryset(self, request, queryset):
+        if self.value() == CustomerLifetimeSpendFilter.NONE:
+            return queryset.filter(stats__isnull=True)
+        if self.value() == CustomerLifetimeSpendFilter.LESS_THAN_100:
+            return queryset.filter(stats__lifetime_spend__lt=100)
+        if self.value() == CustomerLifetimeSpendFilter.BETWEEN_100_AND_1000:
+            return queryset.filter(stats__lifetime_spend__range=(100, 1000))
+        if self.value() == CustomerLifetimeSpendFilter.MORE_THAN_1000:
+            return queryset.filter(stats__lifetime_spend__gt=1000)
+
+
+class OrderAdminForm(forms.ModelForm):
+    class Meta:
+        model = Order
+        fields = '__all__'
+
+    def clean_status(self):
+        status = self.cleaned_data['status']
+        current_status = self.instance.status
+        if self.instance.pk and status != current_status \
+                and status not in Order.ORDER_STATUS_TRANSITIONS[current_status]:
+            raise forms.ValidationError(
+                f'An order can not go from {self.instance.get_status_display()} to this status.'
+                )
+        return status
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
+    form = OrderAdminForm
     list_display = [
         'id',
         'customer',
         'status',
         'datetime_created',
+        'total_price',
         'num_of_items'
         ]
     list_per_page = 10
-    list_editable = ['status']
+    list_filter = ['status', OrderTotalPriceFilter]
     ordering = ['-datetime_created']
+    readonly_fields = ['total_price', 'item_count']
     search_fields = ['id']
     inlines = [OrderItemInline]
+    actions = ['mark_paid', 'mark_canceled']
 
-    def get_queryset(self, request: HttpRequest):
-        return super()\
-                .get_queryset(request)\
-                .prefetch_related('items') \
-                .annotate(items_count=Count('items'))
+    def _transition_status(self, request, queryset, to_status):
+        # Counted first: the changelist filter may no longer match afterwards.
+        selected_count = queryset.count()
+        changed = queryset.transition_status(to_status)
+        updated_count = sum(len(order_ids) for order_ids in changed.values())
+        self.message_user(
+            request,
+            f'{updated_count} of {selected_count} selected orders marked as '
+            f'{dict(Order.ORDER_STATUS)[to_status].lower()}.',
+            messages.SUCCESS,
+        )
+
+    @admin.action(description='Mark selected orders as paid')
+    def mark_paid(self, request, queryset):
+        self._transition_status(request, queryset, Order.ORDER_STATUS_PAID)
 
-    @admin.display(ordering='items_count', description='# items')
+    @admin.action(description='Mark selected orders as canceled')
+    def mark_canceled(self, request, queryset):
+        self._transition_status(request, queryset, Order.ORDER_STATUS_CANCELED)
+
+    @admin.display(ordering='item_count', description='# items')
     def num_of_items(self, order: Order):
-        return order.items_count
+        return order.item_count
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.update_totals()
+        # Sent once the inline items are saved, so the tasks it enqueues see
+        # the final items and total; the admin view's transaction commits them.
+        if change and 'status' in form.changed_data:
+            order_status_changed.send(
+                sender=Order,
+                order_ids=[form.instance.id],
+                from_status=form.initial['status'],
+                to_status=form.instance.status,
+                )
+
+
+class ArchivedOrderItemInline(admin.TabularInline):
+    model = ArchivedOrderItem
+    fields = ['product', 'quantity', 'unit_price']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = [
+        'id',
+        'customer',
+        'status',
+        'datetime_created',
+        'total_price',
+        'item_count',
+        ]
+    list_per_page = 10
+    list_select_related = ['customer__user']
+    list_filter = ['status']
+    ordering = ['-datetime_created']
+    search_fields = ['id']
+    inlines = [ArchivedOrderItemInline]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(PaymentAttempt)
+class PaymentAttemptAdmin(admin.ModelAdmin):
+    list_display = ['id', 'order_id', 'authority', 'amount', 'status', 'ref_id', 'datetime_created']
+    list_per_page = 10
+    list_filter = ['status']
+    ordering = ['-datetime_created']
+    search_fields = ['authority', 'ref_id', '=order__id']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(PrivateEmail)
+class PrivateEmailAdmin(admin.ModelAdmin):
+    list_display = ['id', 'customer', 'subject', 'status', 'attempts', 'next_attempt_at', 'datetime_sent']
+    list_per_page = 10
+    list_select_related = ['customer__user']
+    list_filter = ['status']
+    ordering = ['-datetime_created']
+    autocomplete_fields = ['customer']
 
 
 @admin.register(Comment)
@@ -138,10 +306,28 @@ class CommentAdmin(admin.ModelAdmin):
 
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
-    list_display = ['first_name', 'last_name', 'email', 'phone_number']
+    list_display = [
+        'first_name',
+        'last_name',
+        'email',
+        'phone_number',
+        'order_count',
+        'lifetime_spend',
+        'average_basket',
+        'last_order_at',
+        ]
     list_per_page = 10
+    list_select_related = ['user', 'stats']
+    list_filter = [CustomerLifetimeSpendFilter, 'stats__last_order_at']
     ordering = ['user__last_name', 'user__first_name']
-    search_fields = ['first_name__istartswith', 'last_name__istartswith']
+    search_fields = [
+        'user__first_name__istartswith',
+        'user__last_name__istartswith',
+        'user__email__istartswith',
+        'phone_number__istartswith',
+        ]
+    # COUNT(*) over millions of customers on every search is not instant
+    show_full_result_count = False
 
     def first_name(self, customer: Customer):
         return customer.user.first_name
@@ -152,6 +338,27 @@ class CustomerAdmin(admin.ModelAdmin):
     def email(self, customer: Customer):
         return customer.user.email
 
+    # Customers without paid orders have no stats row.
+    @admin.display(ordering='stats__order_count', description='# orders')
+    def order_count(self, customer: Customer):
+        stats = getattr(customer, 'stats', None)
+        return stats.order_count if stats else 0
+
+    @admin.display(ordering='stats__lifetime_spend')
+    def lifetime_spend(self, customer: Customer):
+        stats = getattr(customer, 'stats', None)
+        return stats.lifetime_spend if stats else 0
+
+    @admin.display(ordering='stats__average_basket')
+    def average_basket(self, customer: Customer):
+        stats = getattr(customer, 'stats', None)
+        return stats.average_basket if stats else 0
+
+    @admin.display(ordering='stats__last_order_at')
+    def last_order_at(self, customer: Customer):
+        stats = getattr(customer, 'stats', None)
+        return stats.last_order_at if stats else None
+
 
 @admin.register(OrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
@@ -163,6 +370,20 @@ class OrderItemAdmin(admin.ModelAdmin):
     list_per_page = 10
     autocomplete_fields = ['product']
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        obj.order.update_totals()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        obj.order.update_totals()
+
+    def delete_queryset(self, request, queryset):
+        orders = list(Order.objects.filter(id__in=queryset.values('order_id')))
+        super().delete_queryset(request, queryset)
+        for order in orders:
+            order.update_totals()
+
 
 class CartItemInline(admin.TabularInline):
     model = CartItem
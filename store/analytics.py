@@ -0,0 +1,144 @@
+from datetime import datetime, time, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DecimalField, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import ArchivedOrderItem, DailyCategorySales, DailyProductSales, DailySales, Order, OrderItem
+
+# rollup model, OrderItem fields and expressions its rows are grouped by
+ROLLUPS = [
+    (DailySales, [], {}),
+    (DailyCategorySales, [], {'category_id': F('product__category_id')}),
+    (DailyProductSales, ['product_id'], {'category_id': F('product__category_id')}),
+]
+
+
+def _start_of_day(date):
+    return timezone.make_aware(datetime.combine(date, time.min))
+
+
+def _aggregate(items, fields, expressions):
+    return items\
+        .annotate(date=TruncDate('order__datetime_created'))\
+        .values('date', *fields, **expressions)\
+        .annotate(
+            revenue=Sum(F('unit_price') * F('quantity'), output_field=DecimalField(max_digits=14, decimal_places=2)),
+            units=Sum('quantity'),
+            orders=Count('order_id', distinct=True),
+            )\
+        .order_by()
+
+
+def _aggregate_all(item_querysets, fields, expressions):
+    # An order lives in exactly one of the hot and archive tables, so the
+    # rows of both can be added up key by key.
+    keys = ['date', *fields, *expressions]
+    rows = {}
+    for items in item_querysets:
+        for row in _aggregate(items, fields, expressions):
+            key = tuple(row[field] for field in keys)
+            if key in rows:
+                for metric in ['revenue', 'units', 'orders']:
+                    rows[key][metric] += row[metric]
+            else:
+                rows[key] = row
+    return rows.values()
+
+
+def rebuild_sales_rollups(start_date, end_date):
+    """
+    Recompute every rollup row between the two dates from the paid orders,
+    archived ones included.
+    """
+    paid_between = {
+        'order__status': Order.ORDER_STATUS_PAID,
+        'order__datetime_created__gte': _start_of_day(start_date),
+        'order__datetime_created__lt': _start_of_day(end_date + timedelta(days=1)),
+    }
+    item_querysets = [
+        OrderItem.objects.filter(**paid_between),
+        ArchivedOrderItem.objects.filter(**paid_between),
+        ]
+
+    with transaction.atomic():
+        for model, fields, expressions in ROLLUPS:
+            model.objects.filter(date__range=(start_date, end_date)).delete()
+            model.objects.bulk_create(
+                [model(**row) for row in _aggregate_all(item_querysets, fields, expressions)],
+                batch_size=1000,
+                )
+
+
+def _apply_delta(model, key, revenue, units, orders):
+    updated = model.objects.filter(**key).update(
+        revenue=F('revenue') + revenue,
+        units=F('units') + units,
+        orders=F('orders') + orders,
+        )
+    if updated:
+        return
+
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, revenue=revenue, units=units, orders=orders)
+    except IntegrityError:
+        # A concurrent writer created the row first.
+        _apply_delta(model, key, revenue, units, orders)
+
+
+def apply_orders_to_sales_rollups(order_ids, sign=1):
+    """
+    Add (sign=1) or remove (sign=-1) the given orders to the rollups.
+
+    Only the rows touched by these orders are updated, with one grouped
+    read of their items and one increment per touched row.
+    """
+    items = OrderItem.objects.filter(order_id__in=order_ids)
+
+    with transaction.atomic():
+        for model, fields, expressions in ROLLUPS:
+            for row in _aggregate(items, fields, expressions):
+                key = {field: row[field] for field in ['date', *fields, *expressions]}
+                _apply_delta(
+                    model,
+                    key,
+                    revenue=sign * row['revenue'],
+                    units=sign * row['units'],
+                    orders=sign * row['orders'],
+                    )
+
+
+def sales_time_series(start_date, end_date, product_id=None, category_id=None):
+    if product_id is not None:
+        queryset = DailyProductSales.objects.filter(product_id=product_id)
+    elif category_id is not None:
+        queryset = DailyCategorySales.objects.filter(category_id=category_id)
+    else:
+        queryset = DailySales.objects.all()
+
+    return queryset\
+        .filter(date__range=(start_date, end_date))\
+        .order_by('date')\
+        .values('date', 'revenue', 'units', 'orders')
+
+
+def top_sellers(start_date, end_date, group_by, metric, limit, category_id=None):
+    if group_by == 'product':
+        key = 'product_id'
+        queryset = DailyProductSales.objects.values(key, name=F('product__name'))
+        if category_id is not None:
+            queryset = queryset.filter(category_id=category_id)
+    else:
+        key = 'category_id'
+        queryset = DailyCategorySales.objects.values(key, name=F('category__title'))
+
+    return queryset\
+        .filter(date__range=(start_date, end_date))\
+        .annotate(
+            total_revenue=Sum('revenue'),
+            total_units=Sum('units'),
+            total_orders=Sum('orders'),
+            )\
+        .order_by(f'-total_{metric}', key)[:limit]
@@ -0,0 +1,58 @@
+from django.db import transaction
+
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+
+ARCHIVED_ORDER_FIELDS = [
+    'id',
+    'customer_id',
+    'datetime_created',
+    'status',
+    'total_price',
+    'item_count',
+    'zarinpal_authority',
+    'zarinpal_ref_id',
+    'zarinpal_data',
+]
+ARCHIVED_ORDER_ITEM_FIELDS = ['id', 'order_id', 'product_id', 'quantity', 'unit_price']
+
+
+def archive_orders(created_before, batch_size=500):
+    """
+    Move paid and canceled orders created before `created_before`, with
+    their items, into the archive tables.
+
+    Each batch is claimed with SELECT ... FOR UPDATE SKIP LOCKED, copied with
+    two bulk inserts and removed with two filtered deletes in one
+    transaction. Returns the number of archived orders.
+    """
+    archived_count = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            orders = list(
+                Order.objects
+                .select_for_update(skip_locked=True)
+                .filter(
+                    status__in=[Order.ORDER_STATUS_PAID, Order.ORDER_STATUS_CANCELED],
+                    datetime_created__lt=created_before,
+                    id__gt=last_id,
+                    )
+                .order_by('id')
+                .values(*ARCHIVED_ORDER_FIELDS)[:batch_size]
+                )
+            if not orders:
+                return archived_count
+            order_ids = [order['id'] for order in orders]
+            last_id = order_ids[-1]
+
+            items = OrderItem.objects\
+                .filter(order_id__in=order_ids)\
+                .values(*ARCHIVED_ORDER_ITEM_FIELDS)
+
+            ArchivedOrder.objects.bulk_create(ArchivedOrder(**order) for order in orders)
+            ArchivedOrderItem.objects.bulk_create(ArchivedOrderItem(**item) for item in items)
+
+            OrderItem.objects.filter(order_id__in=order_ids).delete()
+            Order.objects.filter(id__in=order_ids).delete()
+
+            archived_count += len(order_ids)
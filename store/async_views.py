@@ -0,0 +1,109 @@
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseRedirect, JsonResponse
+from django.urls import reverse
+from django.views import View
+from rest_framework import exceptions, status
+from rest_framework.settings import api_settings
+
+from store import zarinpal
+
+from .idempotency import async_idempotent
+from .models import Order, PaymentAttempt
+
+
+async def authenticate(request):
+    """Run the configured DRF authentication classes off the event loop."""
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            user_auth_tuple = await sync_to_async(authentication_class().authenticate)(request)
+        except exceptions.APIException:
+            return None
+        if user_auth_tuple is not None:
+            return user_auth_tuple[0]
+    return None
+
+
+class AsyncPaymentView(View):
+    http_method_names = ['get', 'options', 'head']
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await authenticate(request)
+        if request.user is None:
+            return JsonResponse(
+                {'detail': 'Authentication credentials were not provided.'},
+                status=status.HTTP_401_UNAUTHORIZED,
+                )
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncOrderPayView(AsyncPaymentView):
+    @async_idempotent
+    async def get(self, request, order_id):
+        try:
+            order = await Order.objects.aget(id=order_id)
+        except Order.DoesNotExist:
+            return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        if order.status == Order.ORDER_STATUS_PAID:
+            return JsonResponse('This order has been paid!', safe=False)
+        if order.status != Order.ORDER_STATUS_UNPAID:
+            return JsonResponse({'error': 'This order has been canceled and can not be paid.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        amount = zarinpal.payment_amount(order)
+        try:
+            data = await zarinpal.async_client.request_payment(
+                amount=amount,
+                description='TechnoShop',
+                callback_url=zarinpal.callback_url(request.build_absolute_uri(reverse('store:order_verify_async')), order),
+                )
+        except zarinpal.ZarinpalError:
+            return JsonResponse({'error': 'Zarinpal is not available'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        if data.get('Status') == 100 and data.get('Authority'):
+            attempt = await sync_to_async(PaymentAttempt.start)(order, amount, data)
+            return HttpResponseRedirect(zarinpal.async_client.start_pay_url(attempt.authority))
+        else:
+            return JsonResponse({'error': 'Error from zarinpal'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class AsyncOrderVerifyView(AsyncPaymentView):
+    async def get(self, request):
+        payment_authority = request.GET.get('Authority')
+        payment_status = request.GET.get('Status')
+
+        order_id = zarinpal.callback_order_id(request.GET)
+        if order_id is None:
+            return JsonResponse({'error': 'The payment callback is invalid or has expired.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            attempt = await PaymentAttempt.objects.select_related('order').aget(
+                authority=payment_authority,
+                order_id=order_id,
+                )
+        except PaymentAttempt.DoesNotExist:
+            return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        if payment_status != 'OK':
+            return JsonResponse({'error': 'The transaction was unsuccessful or canceled by user !'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        try:
+            data = await zarinpal.async_client.verify_payment(
+                amount=attempt.amount,
+                authority=payment_authority,
+                )
+        except zarinpal.ZarinpalError:
+            return JsonResponse({'error': 'Zarinpal is not available'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        payment_code = data.get('Status')
+
+        if 'errors' not in data and payment_code == 100:
+            await sync_to_async(attempt.succeed)(data)
+            return JsonResponse({'success': 'Your payment has been successfully completed!'})
+        elif 'errors' not in data and payment_code == 101:
+            return JsonResponse({'success': 'Your payment has been successfully completed.'
+                                ' Of course, this transaction has already been registered!'})
+        else:
+            await sync_to_async(attempt.fail)(data)
+            error_code = data.get('errors', {}).get('code')
+            error_message = data.get('errors', {}).get('message')
+            return JsonResponse({'error': f'The transaction was unsuccessful! {error_message} {error_code} '}, status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,65 @@
+from uuid import uuid4
+
+from django.core.cache import cache
+
+from .models import Customer
+
+PURCHASE_HISTORY_TIMEOUT = 60 * 60 * 24
+CUSTOMER_TIMEOUT = 60 * 60
+
+
+def _purchase_history_version_key(customer_id):
+    return f'store:purchases:version:{customer_id}'
+
+
+def get_purchase_history_version(customer_id):
+    return cache.get_or_set(
+        _purchase_history_version_key(customer_id),
+        uuid4().hex,
+        timeout=None,
+        )
+
+
+def purchase_history_key(customer_id, cursor):
+    version = get_purchase_history_version(customer_id)
+    return f'store:purchases:{customer_id}:{version}:{cursor or ""}'
+
+
+def invalidate_purchase_history(*customer_ids):
+    # Moving the version orphans every cached page of these customers.
+    cache.set_many(
+        {_purchase_history_version_key(customer_id): uuid4().hex for customer_id in customer_ids},
+        timeout=None,
+        )
+
+
+def _customer_key(user_id):
+    return f'store:customer:{user_id}'
+
+
+def get_customer(user_id):
+    key = _customer_key(user_id)
+    customer = cache.get(key)
+    if customer is None:
+        customer = Customer.objects.get(user_id=user_id)
+        cache.set(key, customer, CUSTOMER_TIMEOUT)
+    return customer
+
+
+def invalidate_customer(user_id):
+    cache.delete(_customer_key(user_id))
+
+
+def get_request_customer(request):
+    """The customer of request.user, loaded at most once per request."""
+    if not hasattr(request, '_customer'):
+        request._customer = get_customer(request.user.id)
+    return request._customer
+
+
+def get_request_customer_id(request):
+    # Tokens read by StatelessJWTAuthentication carry it as a claim.
+    customer_id = getattr(request.user, 'customer_id', None)
+    if customer_id is None:
+        customer_id = get_request_customer(request).id
+    return customer_id
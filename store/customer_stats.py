@@ -0,0 +1,147 @@
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, DecimalField, F, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import ArchivedOrder, Customer, CustomerStats, Order
+
+
+def _totals(orders):
+    return orders\
+        .values('customer_id')\
+        .annotate(
+            order_count=Count('id'),
+            lifetime_spend=Sum('total_price'),
+            last_order_at=Max('datetime_created'),
+            )\
+        .order_by()
+
+
+def _paid_totals(customer_ids):
+    # An order lives in exactly one of the hot and archive tables.
+    totals = {}
+    for model in [Order, ArchivedOrder]:
+        orders = model.objects.filter(customer_id__in=customer_ids, status=Order.ORDER_STATUS_PAID)
+        for row in _totals(orders):
+            total = totals.get(row['customer_id'])
+            if total is None:
+                totals[row['customer_id']] = row
+                continue
+            total['order_count'] += row['order_count']
+            total['lifetime_spend'] += row['lifetime_spend']
+            total['last_order_at'] = max(total['last_order_at'], row['last_order_at'])
+    return totals.values()
+
+
+def _last_paid_order_at(model):
+    return Subquery(
+        model.objects
+        .filter(customer_id=OuterRef('customer_id'), status=Order.ORDER_STATUS_PAID)
+        .order_by('-datetime_created')
+        .values('datetime_created')[:1]
+        )
+
+
+def _average_basket(lifetime_spend, order_count):
+    if not order_count:
+        return Decimal(0)
+    return (lifetime_spend / order_count).quantize(Decimal('0.01'))
+
+
+def _apply_delta(customer_id, order_count, lifetime_spend, last_order_at):
+    updates = {
+        'order_count': F('order_count') + order_count,
+        'lifetime_spend': F('lifetime_spend') + lifetime_spend,
+    }
+    if last_order_at is not None:
+        updates['last_order_at'] = Greatest(Coalesce('last_order_at', Value(last_order_at)), Value(last_order_at))
+
+    updated = CustomerStats.objects.filter(customer_id=customer_id).update(**updates)
+    if updated or order_count < 0:
+        # Nothing to remove from a missing row; rebuild_customer_stats repairs it.
+        return
+
+    try:
+        with transaction.atomic():
+            CustomerStats.objects.create(
+                customer_id=customer_id,
+                order_count=order_count,
+                lifetime_spend=lifetime_spend,
+                last_order_at=last_order_at,
+                )
+    except IntegrityError:
+        # A concurrent writer created the row first.
+        _apply_delta(customer_id, order_count, lifetime_spend, last_order_at)
+
+
+def apply_orders_to_customer_stats(order_ids, sign=1):
+    """
+    Add (sign=1) the given newly paid orders to their customers' stats, or
+    remove (sign=-1) orders that are no longer paid.
+
+    Only the customers of these orders are touched, with one grouped read of
+    the orders and one increment per customer.
+    """
+    orders = Order.objects.filter(id__in=order_ids)
+    if sign > 0:
+        rows = list(_totals(orders.filter(status=Order.ORDER_STATUS_PAID)))
+    else:
+        # Removed orders are not paid anymore.
+        rows = list(_totals(orders))
+
+    with transaction.atomic():
+        for row in rows:
+            _apply_delta(
+                row['customer_id'],
+                sign * row['order_count'],
+                sign * row['lifetime_spend'],
+                row['last_order_at'] if sign > 0 else None,
+                )
+
+        stats = CustomerStats.objects.filter(customer_id__in=[row['customer_id'] for row in rows])
+        if sign < 0:
+            hot, archived = _last_paid_order_at(Order), _last_paid_order_at(ArchivedOrder)
+            # GREATEST is NULL on MySQL as soon as one side is.
+            stats.update(last_order_at=Greatest(Coalesce(hot, archived), Coalesce(archived, hot)))
+        stats.update(average_basket=Case(
+            When(order_count=0, then=Value(0)),
+            default=F('lifetime_spend') / F('order_count'),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+            ))
+
+
+def rebuild_customer_stats(after_id=0, batch_size=1000):
+    """
+    Recompute the stats of every customer from their paid orders, archived
+    ones included.
+
+    Customers are read in id order in batches; each batch is replaced in one
+    transaction. Yields (last customer id, customers with paid orders) per
+    batch; pass the last id back as `after_id` to resume.
+    """
+    while True:
+        customer_ids = list(
+            Customer.objects
+            .filter(id__gt=after_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:batch_size]
+            )
+        if not customer_ids:
+            return
+        after_id = customer_ids[-1]
+
+        with transaction.atomic():
+            CustomerStats.objects.filter(customer_id__in=customer_ids).delete()
+            stats = CustomerStats.objects.bulk_create([
+                CustomerStats(
+                    customer_id=row['customer_id'],
+                    order_count=row['order_count'],
+                    lifetime_spend=row['lifetime_spend'],
+                    average_basket=_average_basket(row['lifetime_spend'], row['order_count']),
+                    last_order_at=row['last_order_at'],
+                    )
+                for row in _paid_totals(customer_ids)
+                ])
+
+        yield after_id, len(stats)
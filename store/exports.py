@@ -0,0 +1,105 @@
+import csv
+import heapq
+import json
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ArchivedOrderItem, OrderItem
+
+EXPORT_CHUNK_SIZE = 2000
+
+# column name, OrderItem and ArchivedOrderItem lookup
+EXPORT_COLUMNS = [
+    ('order_id', 'order_id'),
+    ('order_status', 'order__status'),
+    ('order_datetime_created', 'order__datetime_created'),
+    ('order_total_price', 'order__total_price'),
+    ('customer_id', 'order__customer_id'),
+    ('customer_first_name', 'order__customer__user__first_name'),
+    ('customer_last_name', 'order__customer__user__last_name'),
+    ('customer_email', 'order__customer__user__email'),
+    ('zarinpal_ref_id', 'order__zarinpal_ref_id'),
+    ('item_id', 'id'),
+    ('product_id', 'product_id'),
+    ('product_name', 'product__name'),
+    ('quantity', 'quantity'),
+    ('unit_price', 'unit_price'),
+]
+EXPORT_HEADER = [column for column, _ in EXPORT_COLUMNS]
+EXPORT_LOOKUPS = [lookup for _, lookup in EXPORT_COLUMNS]
+_ORDER_ID_INDEX = EXPORT_LOOKUPS.index('order_id')
+_ITEM_ID_INDEX = EXPORT_LOOKUPS.index('id')
+
+
+def _start_of_day(date):
+    return timezone.make_aware(datetime.combine(date, time.min))
+
+
+def _position(row):
+    return row[_ORDER_ID_INDEX], row[_ITEM_ID_INDEX]
+
+
+def _keyset_chunks(items):
+    # LIMITed keyset reads keep memory flat; mysqlclient buffers the whole
+    # result of a single query on the client.
+    items = items.order_by('order_id', 'id').values_list(*EXPORT_LOOKUPS)
+    last = None
+    while True:
+        chunk = items
+        if last is not None:
+            chunk = chunk.filter(Q(order_id__gt=last[0]) | Q(order_id=last[0], id__gt=last[1]))
+        rows = list(chunk[:EXPORT_CHUNK_SIZE])
+        yield from rows
+        if len(rows) < EXPORT_CHUNK_SIZE:
+            return
+        last = _position(rows[-1])
+
+
+def export_rows(start=None, end=None, status=None):
+    """
+    Yield one tuple per order item, archived ones included, joined with its
+    order, customer and product, in (order_id, item id) order.
+
+    Items are read in keyset chunks of EXPORT_CHUNK_SIZE, so memory use does
+    not grow with the export.
+    """
+    filters = {}
+    if start is not None:
+        filters['order__datetime_created__gte'] = _start_of_day(start)
+    if end is not None:
+        filters['order__datetime_created__lt'] = _start_of_day(end + timedelta(days=1))
+    if status is not None:
+        filters['order__status'] = status
+
+    return heapq.merge(
+        _keyset_chunks(OrderItem.objects.filter(**filters)),
+        _keyset_chunks(ArchivedOrderItem.objects.filter(**filters)),
+        key=_position,
+        )
+
+
+class _Echo:
+    # csv.writer only needs an object with a write() method.
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_HEADER)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_HEADER, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+}
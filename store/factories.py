@@ -1,13 +1,26 @@
 import random
 import factory
 from datetime import datetime
+from django.conf import settings
 from faker import Faker
-from factory.django import DjangoModelFactory
+from factory.django import DjangoModelFactory, Password
 
 from . import models
 
 faker = Faker()
 
+class UserFactory(DjangoModelFactory):
+    # Saving a user also creates its customer.
+    class Meta:
+        model = settings.AUTH_USER_MODEL
+
+    username = factory.Sequence(lambda n: f'member{n}')
+    email = factory.LazyAttribute(lambda user: f'{user.username}@example.com')
+    first_name = factory.Faker("first_name")
+    last_name = factory.Faker("last_name")
+    password = Password('secret-pass')
+
+
 class CategoryFactory(DjangoModelFactory):
     class Meta:
         model = models.Category
@@ -32,6 +45,7 @@ class ProductFactory(DjangoModelFactory):
     class Meta:
         model = models.Product
 
+    category = factory.SubFactory(CategoryFactory)
     name = factory.LazyAttribute(lambda x: ' '.join([x.capitalize() for x in faker.words(3)]))
     slug = factory.LazyAttribute(lambda x: '-'.join(x.name.split(' ')).lower())
     description = factory.Faker('paragraph', nb_sentences=5, variable_nb_sentences=True)
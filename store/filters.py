@@ -1,6 +1,6 @@
 from django_filters.rest_framework import FilterSet
 
-from .models import Product
+from .models import Customer, Order, Product
 
 
 class ProductFilter(FilterSet):
@@ -10,3 +10,25 @@ class ProductFilter(FilterSet):
             'category_id': ['exact'],
             'inventory': ['exact', 'gt', 'lt'],
         }
+
+
+class OrderFilter(FilterSet):
+    class Meta:
+        model = Order
+        fields = {
+            'status': ['exact'],
+            'customer_id': ['exact'],
+            'datetime_created': ['gte', 'lte'],
+            'total_price': ['gte', 'lte'],
+        }
+
+
+class CustomerFilter(FilterSet):
+    class Meta:
+        model = Customer
+        fields = {
+            'stats__order_count': ['gte', 'lte'],
+            'stats__lifetime_spend': ['gte', 'lte'],
+            'stats__average_basket': ['gte', 'lte'],
+            'stats__last_order_at': ['gte', 'lte'],
+        }
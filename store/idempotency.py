@@ -0,0 +1,170 @@
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+# Seconds a client is asked to wait before retrying a request still in progress
+RETRY_AFTER_SECONDS = 1
+
+
+def _replay(record: IdempotencyKey):
+    return (
+        record.response_body,
+        record.response_status,
+        {**record.response_headers, 'Idempotent-Replayed': 'true'},
+        )
+
+
+def _error(message, status_code, headers=None):
+    return {'error': message}, status_code, headers or {}
+
+
+def _in_progress():
+    return _error(
+        f'A request with this {IDEMPOTENCY_KEY_HEADER} is still in progress.',
+        status.HTTP_409_CONFLICT,
+        {'Retry-After': str(RETRY_AFTER_SECONDS)},
+        )
+
+
+def _begin(request, key):
+    """
+    Claim `key` for this request.
+
+    Returns (record, None) when the request should run and its response be
+    stored in `record`, or (None, (body, status, headers)) for the answer to
+    send instead.
+    """
+    if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+        return None, _error(f'{IDEMPOTENCY_KEY_HEADER} is too long.', status.HTTP_400_BAD_REQUEST)
+
+    now = timezone.now()
+    record = IdempotencyKey.objects.filter(user_id=request.user.id, key=key).first()
+
+    if record is not None and record.expires_at <= now:
+        record.delete()
+        record = None
+
+    if record is None:
+        try:
+            return IdempotencyKey.objects.create(
+                user_id=request.user.id,
+                key=key,
+                request_method=request.method,
+                request_path=request.path,
+                expires_at=now + settings.IDEMPOTENCY_KEY_TTL,
+                ), None
+        except IntegrityError:
+            # Another request with this key won the race, and may
+            # already have failed and deleted its record.
+            record = IdempotencyKey.objects.filter(user_id=request.user.id, key=key).first()
+            if record is None:
+                return None, _in_progress()
+
+    if record.request_method != request.method or record.request_path != request.path:
+        return None, _error(
+            f'This {IDEMPOTENCY_KEY_HEADER} was used for another request.',
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+
+    if not record.is_completed():
+        if record.datetime_created > now - settings.IDEMPOTENCY_KEY_LEASE:
+            return None, _in_progress()
+        # The request that claimed the key died without an answer; take it
+        # over, unless another retry has just done so.
+        taken_over = IdempotencyKey.objects\
+            .filter(pk=record.pk, response_status__isnull=True, datetime_created=record.datetime_created)\
+            .update(datetime_created=now)
+        if not taken_over:
+            return None, _in_progress()
+        record.datetime_created = now
+        return record, None
+
+    return None, _replay(record)
+
+
+def _store(record: IdempotencyKey, response, body):
+    if response.status_code >= 500:
+        # Let the client retry failures from scratch.
+        record.delete()
+        return
+
+    record.response_status = response.status_code
+    record.response_body = body
+    if 'Location' in response:
+        record.response_headers = {'Location': response['Location']}
+    record.save(update_fields=['response_status', 'response_body', 'response_headers'])
+
+
+def idempotent(handler):
+    """
+    Replay the first response for requests repeating an Idempotency-Key.
+
+    Retries arriving while the first request is running get 409 Conflict
+    with Retry-After right away rather than holding a worker thread while
+    they wait for its result. A key left unanswered for
+    IDEMPOTENCY_KEY_LEASE, by a worker killed mid-request, is taken over by
+    the next retry.
+    """
+    @wraps(handler)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if not key:
+            return handler(view, request, *args, **kwargs)
+
+        record, answer = _begin(request, key)
+        if answer is not None:
+            body, status_code, headers = answer
+            return Response(body, status=status_code, headers=headers)
+
+        try:
+            response = handler(view, request, *args, **kwargs)
+        except BaseException:
+            record.delete()
+            raise
+
+        body = None
+        if getattr(response, 'data', None) is not None:
+            body = json.loads(JSONRenderer().render(response.data))
+        _store(record, response, body)
+        return response
+
+    return wrapper
+
+
+def async_idempotent(handler):
+    """idempotent for the async views, which answer with plain JsonResponses."""
+    @wraps(handler)
+    async def wrapper(view, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if not key:
+            return await handler(view, request, *args, **kwargs)
+
+        record, answer = await sync_to_async(_begin)(request, key)
+        if answer is not None:
+            body, status_code, headers = answer
+            return JsonResponse(body, status=status_code, headers=headers, safe=False)
+
+        try:
+            response = await handler(view, request, *args, **kwargs)
+        except BaseException:
+            await record.adelete()
+            raise
+
+        body = None
+        if response.get('Content-Type') == 'application/json':
+            body = json.loads(response.content)
+        await sync_to_async(_store)(record, response, body)
+        return response
+
+    return wrapper
@@ -0,0 +1,119 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.template import Context, Template
+from django.utils import timezone
+
+from .models import PrivateEmail
+from .ratelimit import RateLimiter
+
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = timedelta(minutes=1)
+# How long a claimed email stays invisible to other workers while it is sent
+SEND_LEASE = timedelta(minutes=10)
+
+
+def queue_private_emails(customer_ids, subject, body):
+    """Queue one email per customer; store.mail.send_queued_emails delivers them."""
+    return PrivateEmail.objects.bulk_create(
+        [PrivateEmail(customer_id=customer_id, subject=subject, body=body) for customer_id in customer_ids],
+        batch_size=1000,
+        )
+
+
+def _render_batch(emails):
+    # Blasts share their templates, so each is compiled once per batch.
+    templates = {}
+
+    def render(source, context):
+        if source not in templates:
+            templates[source] = Template(source)
+        return templates[source].render(context)
+
+    messages = []
+    for email in emails:
+        context = Context({'customer': email.customer, 'user': email.customer.user}, autoescape=False)
+        messages.append(EmailMessage(
+            subject=render(email.subject, context),
+            body=render(email.body, context),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[email.customer.user.email],
+            ))
+    return messages
+
+
+def _claim(batch_size, max_attempts):
+    now = timezone.now()
+    with transaction.atomic():
+        due = list(
+            PrivateEmail.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=PrivateEmail.EMAIL_STATUS_QUEUED, next_attempt_at__lte=now)
+            .order_by('next_attempt_at')
+            .values_list('id', 'attempts')[:batch_size]
+            )
+        # Claimed max_attempts times by workers that died before recording a result.
+        exhausted_ids = [email_id for email_id, attempts in due if attempts >= max_attempts]
+        email_ids = [email_id for email_id, attempts in due if attempts < max_attempts]
+        PrivateEmail.objects.filter(id__in=exhausted_ids).update(
+            status=PrivateEmail.EMAIL_STATUS_FAILED,
+            last_error='Send lease expired',
+            )
+        PrivateEmail.objects.filter(id__in=email_ids).update(
+            attempts=F('attempts') + 1,
+            next_attempt_at=now + SEND_LEASE,
+            )
+    emails = list(
+        PrivateEmail.objects
+        .select_related('customer__user')
+        .filter(id__in=email_ids)
+        .order_by('id')
+        )
+    return emails, len(exhausted_ids)
+
+
+def send_queued_emails(batch_size=100, rate=None, max_attempts=MAX_ATTEMPTS, connection=None):
+    """
+    Send one batch of due queued emails over a single SMTP connection.
+
+    The batch is claimed with SELECT ... FOR UPDATE SKIP LOCKED and leased
+    for SEND_LEASE in a short transaction, so several workers can run side
+    by side without holding row locks while talking to the SMTP server. If
+    a worker dies mid-batch, its emails are claimed again once the lease
+    expires. Messages are sent at no more than `rate` per second; a failed
+    message is retried with exponential backoff and marked failed after
+    `max_attempts`. Returns (sent, failed) counts, or None when nothing was
+    due.
+    """
+    emails, failed_count = _claim(batch_size, max_attempts)
+    if not emails and not failed_count:
+        return None
+
+    rate_limiter = RateLimiter(rate)
+    connection = connection or get_connection()
+    sent_count = 0
+    with connection:
+        for email, message in zip(emails, _render_batch(emails)):
+            rate_limiter.wait()
+            try:
+                connection.send_messages([message])
+            except Exception as e:
+                email.last_error = str(e)
+                if email.attempts >= max_attempts:
+                    email.status = PrivateEmail.EMAIL_STATUS_FAILED
+                    failed_count += 1
+                else:
+                    email.next_attempt_at = timezone.now() + RETRY_BACKOFF * 2 ** (email.attempts - 1)
+            else:
+                email.status = PrivateEmail.EMAIL_STATUS_SENT
+                email.datetime_sent = timezone.now()
+                sent_count += 1
+
+    PrivateEmail.objects.bulk_update(
+        emails,
+        ['status', 'last_error', 'next_attempt_at', 'datetime_sent'],
+        )
+    return sent_count, failed_count
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from store.archive import archive_orders
+
+
+class Command(BaseCommand):
+    help = "Moves paid and canceled orders older than settings.ORDER_ARCHIVE_AFTER to the archive tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        archived_count = archive_orders(
+            created_before=timezone.now() - settings.ORDER_ARCHIVE_AFTER,
+            batch_size=options['batch_size'],
+            )
+        self.stdout.write(f"Archived {archived_count} orders.")
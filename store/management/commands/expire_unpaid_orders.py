@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from store.models import Order
+
+
+class Command(BaseCommand):
+    help = "Cancels unpaid orders older than settings.UNPAID_ORDER_TTL"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--restock',
+            action='store_true',
+            help='Return the quantities of canceled orders to product inventory.',
+            )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=0,
+            help='Keep sweeping every INTERVAL seconds instead of running once.',
+            )
+
+    def handle(self, *args, **options):
+        while True:
+            expired_count = Order.unpaid_orders.expire(
+                created_before=timezone.now() - settings.UNPAID_ORDER_TTL,
+                batch_size=options['batch_size'],
+                restock=options['restock'],
+                )
+            self.stdout.write(f"Canceled {expired_count} unpaid orders.")
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from store.exports import EXPORT_FORMATS, export_rows
+from store.models import Order
+
+
+class Command(BaseCommand):
+    help = "Exports order items joined with their orders and customers to a file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the file to write.')
+        parser.add_argument('--start', type=date.fromisoformat, help='YYYY-MM-DD')
+        parser.add_argument('--end', type=date.fromisoformat, help='YYYY-MM-DD')
+        parser.add_argument('--status', choices=[status for status, _ in Order.ORDER_STATUS])
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv')
+
+    def handle(self, *args, **options):
+        rows = export_rows(
+            start=options['start'],
+            end=options['end'],
+            status=options['status'],
+            )
+        render, _ = EXPORT_FORMATS[options['format']]
+
+        with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+            output.writelines(render(rows))
+
+        self.stdout.write(f"Exported orders to {options['output']}.")
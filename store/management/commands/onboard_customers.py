@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from store.onboarding import RECORD_FORMATS, onboard_customers
+
+
+class Command(BaseCommand):
+    help = "Creates users with their customers and addresses in bulk from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'input',
+            help='Path of the file to read. Columns: username, email, password, first_name, last_name, '
+                 'phone_number, birth_date, province, city, street.',
+            )
+        parser.add_argument('--format', choices=list(RECORD_FORMATS), default='csv')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, help='Password hashing processes. Defaults to the CPU count.')
+
+    def handle(self, *args, **options):
+        read = RECORD_FORMATS[options['format']]
+        total_created = 0
+        total_skipped = 0
+
+        with open(options['input'], newline='', encoding='utf-8') as file:
+            for created_count, skipped_count in onboard_customers(
+                    read(file),
+                    batch_size=options['batch_size'],
+                    workers=options['workers'],
+                    ):
+                total_created += created_count
+                total_skipped += skipped_count
+                self.stdout.write(f"Created {created_count} customers, skipped {skipped_count}.")
+
+        self.stdout.write(f"Created {total_created} customers in total, skipped {total_skipped}.")
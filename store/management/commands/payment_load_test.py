@@ -0,0 +1,47 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from store import zarinpal
+from store.zarinpal_stub import StubZarinpalGateway
+
+
+class Command(BaseCommand):
+    help = "Compares sync and async gateway calls against a local stub gateway with injected latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200)
+        parser.add_argument('--latency', type=float, default=0.5, help='Gateway latency in seconds.')
+        parser.add_argument('--workers', type=int, default=8, help='Sync worker threads, like a WSGI pool.')
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+
+        with StubZarinpalGateway(latency=options['latency']) as gateway:
+            client_options = {
+                'request_url': gateway.request_url,
+                'verify_url': gateway.verify_url,
+                'startpay_url': gateway.startpay_url,
+                'timeout': (1, options['latency'] + 5),
+            }
+
+            sync_client = zarinpal.ZarinpalClient('load-test', pool_size=options['workers'], **client_options)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                list(executor.map(lambda i: sync_client.verify_payment(1000, f'A{i}'), range(calls)))
+            sync_elapsed = time.perf_counter() - started
+
+            async_client = zarinpal.AsyncZarinpalClient('load-test', pool_size=calls, **client_options)
+
+            async def verify_all():
+                await asyncio.gather(*[async_client.verify_payment(1000, f'B{i}') for i in range(calls)])
+
+            started = time.perf_counter()
+            asyncio.run(verify_all())
+            async_elapsed = time.perf_counter() - started
+
+        self.stdout.write(f"{calls} verifications, {options['latency']}s gateway latency")
+        self.stdout.write(f"sync, {options['workers']} workers: {sync_elapsed:.2f}s ({calls / sync_elapsed:.1f}/s)")
+        self.stdout.write(f"async, one event loop: {async_elapsed:.2f}s ({calls / async_elapsed:.1f}/s)")
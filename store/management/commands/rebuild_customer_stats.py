@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from store.customer_stats import rebuild_customer_stats
+
+
+class Command(BaseCommand):
+    help = "Recomputes every customer's order count, lifetime spend, average basket and last order date"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this customer id.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for last_id, stats_count in rebuild_customer_stats(
+                after_id=options['after_id'],
+                batch_size=options['batch_size'],
+                ):
+            self.stdout.write(
+                f"Rebuilt stats up to customer id {last_id}: {stats_count} customers with paid orders. "
+                f"Resume with --after-id {last_id}."
+                )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from store.reconciliation import reconcile_payments
+
+
+class Command(BaseCommand):
+    help = "Verifies waiting Zarinpal payment attempts of unpaid orders and marks the paid ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this payment attempt id.')
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--rate', type=float, default=20, help='Gateway calls per second.')
+
+    def handle(self, *args, **options):
+        total_paid = 0
+        for last_id, checked_count, paid_count, declined_count, unreachable_count in reconcile_payments(
+                after_id=options['after_id'],
+                batch_size=options['batch_size'],
+                concurrency=options['concurrency'],
+                rate=options['rate'],
+                ):
+            total_paid += paid_count
+            self.stdout.write(
+                f"Checked {checked_count} payment attempts up to id {last_id}: "
+                f"{paid_count} paid, {declined_count} declined, {unreachable_count} unreachable. "
+                f"Resume with --after-id {last_id}."
+                )
+        self.stdout.write(f"Marked {total_paid} orders as paid.")
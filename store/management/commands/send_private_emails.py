@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.mail import MAX_ATTEMPTS, send_queued_emails
+
+
+class Command(BaseCommand):
+    help = "Sends queued private emails to customers in batches; runs until stopped unless --once is given"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--rate', type=float, help='Messages per second per worker.')
+        parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+        parser.add_argument('--poll-interval', type=float, default=5, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--once', action='store_true', help='Exit when no email is due.')
+
+    def handle(self, *args, **options):
+        while True:
+            result = send_queued_emails(
+                batch_size=options['batch_size'],
+                rate=options['rate'],
+                max_attempts=options['max_attempts'],
+                )
+            if result is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            sent_count, failed_count = result
+            self.stdout.write(f"Sent {sent_count} emails, {failed_count} failed for good.")
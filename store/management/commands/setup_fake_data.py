@@ -57,7 +57,7 @@ class Command(BaseCommand):
         print(f"Adding {NUM_PRODUCTS} product...", end='')
         all_products = list()
         for _ in range(NUM_PRODUCTS):
-            new_product = ProductFactory(category_id=random.choice(all_categories).id)
+            new_product = ProductFactory(category=random.choice(all_categories))
             new_product.datetime_created = faker.date_time_ad(start_datetime=datetime(2022,1,1), end_datetime=datetime(2023,1,1))
             new_product.datetime_modified = new_product.datetime_created + timedelta(hours=random.randint(1, 5000))
             all_products.append(new_product)
@@ -96,6 +96,7 @@ class Command(BaseCommand):
                     unit_price=product.unit_price,
                 )
                 all_order_items.append(order_item)
+            order.update_totals()
         print('DONE')
 
         # Comments data
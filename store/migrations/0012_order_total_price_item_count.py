@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:09
+
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_order_totals(apps, schema_editor):
+    Order = apps.get_model('store', 'Order')
+    OrderItem = apps.get_model('store', 'OrderItem')
+
+    items = OrderItem.objects.filter(order_id=OuterRef('pk')).values('order_id')
+    Order.objects.update(
+        total_price=Coalesce(
+            Subquery(
+                items.annotate(
+                    total=Sum(F('unit_price') * F('quantity'), output_field=DecimalField())
+                ).values('total')
+            ),
+            0,
+            output_field=DecimalField(),
+        ),
+        item_count=Coalesce(
+            Subquery(items.annotate(count=Count('id')).values('count')),
+            0,
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_order_zarinpal_authority_order_zarinpal_data_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_price',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,113 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:23
+
+import ast
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def _to_json(value):
+    # Gateway answers used to be saved as str(dict).
+    try:
+        return json.dumps(ast.literal_eval(value))
+    except (ValueError, SyntaxError):
+        return json.dumps({'raw': value})
+
+
+def convert_zarinpal_fields(apps, schema_editor):
+    for model_name in ['Order', 'ArchivedOrder']:
+        model = apps.get_model('store', model_name)
+        model.objects.filter(zarinpal_authority='').update(zarinpal_authority=None)
+        model.objects.filter(zarinpal_data='').update(zarinpal_data=None)
+
+        rows = model.objects.exclude(zarinpal_data=None).only('id', 'zarinpal_data')
+        for row in rows.iterator(chunk_size=1000):
+            row.zarinpal_data = _to_json(row.zarinpal_data)
+            row.save(update_fields=['zarinpal_data'])
+
+
+def create_payment_attempts(apps, schema_editor):
+    Order = apps.get_model('store', 'Order')
+    PaymentAttempt = apps.get_model('store', 'PaymentAttempt')
+
+    orders = Order.objects.exclude(zarinpal_authority=None)
+    PaymentAttempt.objects.bulk_create(
+        [
+            PaymentAttempt(
+                order_id=order.id,
+                authority=order.zarinpal_authority,
+                amount=int(order.total_price * 50000),
+                status='s' if order.status == 'p' else 'w',
+                ref_id=order.zarinpal_ref_id,
+                verify_data=order.zarinpal_data,
+            )
+            for order in orders.iterator(chunk_size=1000)
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0017_archived_orders'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='zarinpal_authority',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='zarinpal_data',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='archivedorder',
+            name='zarinpal_authority',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='archivedorder',
+            name='zarinpal_data',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.RunPython(convert_zarinpal_fields, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='zarinpal_authority',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='zarinpal_data',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='archivedorder',
+            name='zarinpal_data',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='PaymentAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('authority', models.CharField(max_length=255, unique=True)),
+                ('amount', models.PositiveBigIntegerField()),
+                ('status', models.CharField(choices=[('w', 'Waiting'), ('s', 'Succeeded'), ('f', 'Failed')], default='w', max_length=1)),
+                ('ref_id', models.CharField(blank=True, max_length=150)),
+                ('request_data', models.JSONField(blank=True, default=dict)),
+                ('verify_data', models.JSONField(blank=True, null=True)),
+                ('datetime_created', models.DateTimeField(auto_now_add=True)),
+                ('datetime_modified', models.DateTimeField(auto_now=True)),
+                ('order', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='payment_attempts', to='store.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'datetime_created'], name='store_payme_status_11e252_idx')],
+            },
+        ),
+        migrations.RunPython(create_payment_attempts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_customer_phone_number_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerStats',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='store.customer')),
+                ('order_count', models.PositiveIntegerField(db_index=True, default=0)),
+                ('lifetime_spend', models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=14)),
+                ('average_basket', models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=12)),
+                ('last_order_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+            ],
+        ),
+    ]
@@ -1,9 +1,13 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Subquery, Sum
 from django.core.validators import MinValueValidator
 from django.conf import settings
+from django.utils import timezone
 
 from uuid import uuid4
 
+from .signals import order_status_changed
+
 
 class Category(models.Model):
     title = models.CharField(max_length=255)
@@ -38,13 +42,20 @@ class Product(models.Model):
     datetime_created = models.DateTimeField(auto_now_add=True)
     datetime_modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # back the admin date hierarchy and inventory filter
+        indexes = [
+            models.Index(fields=['datetime_created']),
+            models.Index(fields=['inventory']),
+        ]
+
     def __str__(self):
         return self.name
 
 
 class Customer(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.PROTECT)
-    phone_number = models.CharField(max_length=255)
+    phone_number = models.CharField(max_length=255, db_index=True)
     birth_date = models.DateField(null=True, blank=True)
 
     class Meta:
@@ -56,6 +67,15 @@ class Customer(models.Model):
         return f'{self.user.first_name} {self.user.last_name}'
 
 
+class CustomerStats(models.Model):
+    # Paid orders only; kept up to date by store.customer_stats.
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    order_count = models.PositiveIntegerField(default=0, db_index=True)
+    lifetime_spend = models.DecimalField(max_digits=14, decimal_places=2, default=0, db_index=True)
+    average_basket = models.DecimalField(max_digits=12, decimal_places=2, default=0, db_index=True)
+    last_order_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+
 class Address(models.Model):
     customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True)
     province = models.CharField(max_length=255)
@@ -67,6 +87,86 @@ class UnpaidOrderManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset().filter(status=Order.ORDER_STATUS_UNPAID)
 
+    def expire(self, created_before, batch_size=1000, restock=False):
+        """
+        Cancel unpaid orders created before `created_before`.
+
+        Orders are claimed in id order with SELECT ... FOR UPDATE SKIP LOCKED,
+        so several sweepers can run side by side without touching the same
+        rows. Orders with a waiting payment attempt are skipped until
+        reconcile_payments has settled it, as the gateway may still report
+        them paid. Each batch is cancelled with one UPDATE and, with
+        `restock`, its quantities go back to the products in one more
+        UPDATE. Returns the number of cancelled orders.
+        """
+        expired_count = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                order_ids = list(
+                    self.get_queryset()
+                    .select_for_update(skip_locked=True)
+                    .filter(datetime_created__lt=created_before, id__gt=last_id)
+                    .exclude(has_waiting_payment_attempt())
+                    .order_by('id')
+                    .values_list('id', flat=True)[:batch_size]
+                    )
+                if not order_ids:
+                    return expired_count
+                last_id = order_ids[-1]
+
+                if restock:
+                    items = OrderItem.objects.filter(order_id__in=order_ids)
+                    Product.objects\
+                        .filter(id__in=items.values('product_id'))\
+                        .update(inventory=F('inventory') + Subquery(
+                            items.filter(product_id=OuterRef('pk'))
+                            .values('product_id')
+                            .annotate(quantity=Sum('quantity'))
+                            .values('quantity')
+                            ))
+
+                expired_count += Order.objects\
+                    .filter(id__in=order_ids)\
+                    .update(status=Order.ORDER_STATUS_CANCELED)
+
+                order_status_changed.send(
+                    sender=Order,
+                    order_ids=order_ids,
+                    from_status=Order.ORDER_STATUS_UNPAID,
+                    to_status=Order.ORDER_STATUS_CANCELED,
+                    )
+
+
+class OrderQuerySet(models.QuerySet):
+    def transition_status(self, to_status):
+        """
+        Move the orders to `to_status` where Order.ORDER_STATUS_TRANSITIONS
+        allows it, with one UPDATE per source status.
+
+        Sends one order_status_changed signal per applied transition inside
+        the transaction, so the tasks its receivers enqueue commit with the
+        new statuses. Returns {from_status: [order ids]}.
+        """
+        changed = {}
+        with transaction.atomic():
+            for order_id, from_status in self.select_for_update().values_list('id', 'status'):
+                if to_status in Order.ORDER_STATUS_TRANSITIONS[from_status]:
+                    changed.setdefault(from_status, []).append(order_id)
+
+            for from_status, order_ids in changed.items():
+                Order.objects\
+                    .filter(id__in=order_ids, status=from_status)\
+                    .update(status=to_status)
+                order_status_changed.send(
+                    sender=Order,
+                    order_ids=order_ids,
+                    from_status=from_status,
+                    to_status=to_status,
+                    )
+
+        return changed
+
 
 class Order(models.Model):
     ORDER_STATUS_PAID = 'p'
@@ -80,21 +180,48 @@ class Order(models.Model):
 
     ]
 
+    ORDER_STATUS_TRANSITIONS = {
+        ORDER_STATUS_UNPAID: [ORDER_STATUS_PAID, ORDER_STATUS_CANCELED],
+        ORDER_STATUS_PAID: [ORDER_STATUS_CANCELED],
+        ORDER_STATUS_CANCELED: [],
+    }
+
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='orders')
     datetime_created = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=1, choices=ORDER_STATUS, default=ORDER_STATUS_UNPAID)
 
-    zarinpal_authority = models.CharField(max_length=255, blank=True)
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, default=0, db_index=True)
+    item_count = models.PositiveIntegerField(default=0, db_index=True)
+
+    zarinpal_authority = models.CharField(max_length=255, null=True, blank=True, unique=True)
     zarinpal_ref_id = models.CharField(max_length=150, blank=True)
-    zarinpal_data = models.TextField(blank=True)
+    zarinpal_data = models.JSONField(null=True, blank=True)
 
-    objects = models.Manager()
+    objects = OrderQuerySet.as_manager()
     unpaid_orders = UnpaidOrderManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'datetime_created']),
+            models.Index(fields=['customer', 'datetime_created']),
+        ]
+
     def get_total_price(self):
         total = sum([item.get_cost() for item in self.items.all()])
         return total
 
+    def update_totals(self):
+        totals = self.items.aggregate(
+            total_price=Sum(F('unit_price') * F('quantity'), output_field=models.DecimalField()),
+            item_count=Count('id'),
+            )
+        self.total_price = totals['total_price'] or 0
+        self.item_count = totals['item_count']
+        Order.objects.filter(pk=self.pk).update(
+            total_price=self.total_price,
+            item_count=self.item_count,
+            )
+
     def __str__(self):
         return f'order id: {self.id}'
 
@@ -107,6 +234,145 @@ class OrderItem(models.Model):
 
     class Meta:
         unique_together = [['order', 'product']]
+        indexes = [
+            # covers the purchase history aggregation per order
+            models.Index(fields=['order', 'product', 'quantity']),
+        ]
+
+    def get_cost(self):
+        return self.unit_price * self.quantity
+
+
+class PaymentAttempt(models.Model):
+    PAYMENT_STATUS_WAITING = 'w'
+    PAYMENT_STATUS_SUCCEEDED = 's'
+    PAYMENT_STATUS_FAILED = 'f'
+
+    PAYMENT_STATUS = [
+        (PAYMENT_STATUS_WAITING, 'Waiting'),
+        (PAYMENT_STATUS_SUCCEEDED, 'Succeeded'),
+        (PAYMENT_STATUS_FAILED, 'Failed'),
+    ]
+
+    # No database constraint: attempts outlive orders that are archived or
+    # returned to the cart.
+    order = models.ForeignKey(
+        Order,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name='payment_attempts',
+        )
+    authority = models.CharField(max_length=255, unique=True)
+    amount = models.PositiveBigIntegerField()
+    status = models.CharField(max_length=1, choices=PAYMENT_STATUS, default=PAYMENT_STATUS_WAITING)
+    ref_id = models.CharField(max_length=150, blank=True)
+    request_data = models.JSONField(default=dict, blank=True)
+    verify_data = models.JSONField(null=True, blank=True)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+    datetime_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'datetime_created']),
+        ]
+
+    def __str__(self):
+        return f'payment attempt {self.authority}'
+
+    @classmethod
+    def start(cls, order, amount, data):
+        """Record the authority the gateway gave `order` for a new payment."""
+        with transaction.atomic():
+            order.zarinpal_authority = data['Authority']
+            order.save(update_fields=['zarinpal_authority'])
+            return cls.objects.create(
+                order=order,
+                authority=data['Authority'],
+                amount=amount,
+                request_data=data,
+                )
+
+    def succeed(self, data):
+        """
+        Mark the attempt as succeeded and its order as paid from a
+        verification answer.
+
+        The order row is locked and read again, so when the callback and
+        reconcile_payments settle the same payment, only the first one moves
+        the order to paid.
+        """
+        with transaction.atomic():
+            order = Order.objects.select_for_update().get(pk=self.order_id)
+
+            self.status = PaymentAttempt.PAYMENT_STATUS_SUCCEEDED
+            self.ref_id = str(data.get('RefID', ''))
+            self.verify_data = data
+            self.save(update_fields=['status', 'ref_id', 'verify_data', 'datetime_modified'])
+
+            self.order = order
+            if order.status == Order.ORDER_STATUS_PAID:
+                return
+
+            from_status = order.status
+            order.status = Order.ORDER_STATUS_PAID
+            order.zarinpal_ref_id = self.ref_id
+            order.zarinpal_data = data
+            order.save(update_fields=['status', 'zarinpal_ref_id', 'zarinpal_data'])
+
+            order_status_changed.send(
+                sender=Order,
+                order_ids=[order.id],
+                from_status=from_status,
+                to_status=Order.ORDER_STATUS_PAID,
+                )
+
+    def fail(self, data):
+        self.status = PaymentAttempt.PAYMENT_STATUS_FAILED
+        self.verify_data = data
+        self.save(update_fields=['status', 'verify_data', 'datetime_modified'])
+
+
+def has_waiting_payment_attempt():
+    """
+    Whether the order has a payment attempt the gateway may still report as
+    paid. Such orders are left for reconcile_payments to settle.
+    """
+    return Exists(PaymentAttempt.objects.filter(
+        order_id=OuterRef('pk'),
+        status=PaymentAttempt.PAYMENT_STATUS_WAITING,
+        ))
+
+
+class ArchivedOrder(models.Model):
+    # Keeps the id the order had in the hot table.
+    id = models.BigIntegerField(primary_key=True)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='archived_orders')
+    datetime_created = models.DateTimeField()
+    status = models.CharField(max_length=1, choices=Order.ORDER_STATUS)
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
+
+    zarinpal_authority = models.CharField(max_length=255, null=True, blank=True)
+    zarinpal_ref_id = models.CharField(max_length=150, blank=True)
+    zarinpal_data = models.JSONField(null=True, blank=True)
+
+    datetime_archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer', 'datetime_created']),
+        ]
+
+    def __str__(self):
+        return f'archived order id: {self.id}'
+
+
+class ArchivedOrderItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, related_name='archived_order_items')
+    quantity = models.PositiveSmallIntegerField(default=1)
+    unit_price = models.DecimalField(max_digits=6, decimal_places=2)
 
     def get_cost(self):
         return self.unit_price * self.quantity
@@ -154,3 +420,87 @@ class CartItem(models.Model):
 
     class Meta:
         unique_together = [['cart', 'product']]
+
+
+class PrivateEmail(models.Model):
+    EMAIL_STATUS_QUEUED = 'q'
+    EMAIL_STATUS_SENT = 's'
+    EMAIL_STATUS_FAILED = 'f'
+
+    EMAIL_STATUS = [
+        (EMAIL_STATUS_QUEUED, 'Queued'),
+        (EMAIL_STATUS_SENT, 'Sent'),
+        (EMAIL_STATUS_FAILED, 'Failed'),
+    ]
+
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='private_emails')
+    # Django templates, rendered with `customer` and `user` by store.mail
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=1, choices=EMAIL_STATUS, default=EMAIL_STATUS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+    datetime_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=255)
+    request_method = models.CharField(max_length=10)
+    request_path = models.CharField(max_length=255)
+    # response_status stays empty while the first request is still running
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    response_headers = models.JSONField(default=dict, blank=True)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = [['user', 'key']]
+
+    def is_completed(self):
+        return self.response_status is not None
+
+
+class DailySales(models.Model):
+    date = models.DateField(unique=True)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+
+class DailyCategorySales(models.Model):
+    date = models.DateField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [['date', 'category']]
+        indexes = [
+            models.Index(fields=['category', 'date']),
+        ]
+
+
+class DailyProductSales(models.Model):
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [['date', 'product']]
+        indexes = [
+            models.Index(fields=['product', 'date']),
+            models.Index(fields=['category', 'date']),
+        ]
@@ -0,0 +1,158 @@
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from itertools import islice
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Address, Customer
+
+ADDRESS_FIELDS = ['province', 'city', 'street']
+
+
+def read_csv(file):
+    yield from csv.DictReader(file)
+
+
+def read_ndjson(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+RECORD_FORMATS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+def _init_worker():
+    # Needed where worker processes are spawned rather than forked.
+    django.setup()
+
+
+def _batches(records, batch_size):
+    records = iter(records)
+    while batch := list(islice(records, batch_size)):
+        yield batch
+
+
+def _parse_birth_date(record):
+    if not record.get('birth_date'):
+        return None
+    return date.fromisoformat(record['birth_date'])
+
+
+def _new_records(user_model, batch):
+    """
+    Normalize the batch and drop records whose username or email is taken,
+    or whose birth_date is malformed.
+
+    Usernames and emails are compared case-folded, as the unique indexes on
+    MySQL are case-insensitive.
+    """
+    records = {}
+    emails = set()
+    for record in batch:
+        username = user_model.normalize_username(record.get('username', ''))
+        email = user_model.objects.normalize_email(record.get('email', ''))
+        if not username or not email or username.casefold() in records or email.casefold() in emails:
+            continue
+        try:
+            birth_date = _parse_birth_date(record)
+        except ValueError:
+            continue
+        records[username.casefold()] = {**record, 'username': username, 'email': email, 'birth_date': birth_date}
+        emails.add(email.casefold())
+
+    # The lookups match case-insensitively on MySQL's collation and still
+    # use the unique indexes; the matches are folded again here.
+    taken = user_model.objects\
+        .filter(
+            Q(username__in=[record['username'] for record in records.values()])
+            | Q(email__in=[record['email'] for record in records.values()])
+            )\
+        .values_list('username', 'email')
+    for username, email in taken:
+        records.pop(username.casefold(), None)
+        emails.discard(email.casefold())
+    return [record for record in records.values() if record['email'].casefold() in emails]
+
+
+def _create_batch(user_model, records, password_hashes):
+    with transaction.atomic():
+        user_model.objects.bulk_create([
+            user_model(
+                username=record['username'],
+                email=record['email'],
+                first_name=record.get('first_name', ''),
+                last_name=record.get('last_name', ''),
+                password=password_hash,
+                )
+            for record, password_hash in zip(records, password_hashes)
+            ])
+        # Not every backend (MySQL) returns the new primary keys.
+        user_ids = dict(
+            user_model.objects
+            .filter(username__in=[record['username'] for record in records])
+            .values_list('username', 'id')
+            )
+
+        Customer.objects.bulk_create([
+            Customer(
+                user_id=user_ids[record['username']],
+                phone_number=record.get('phone_number', ''),
+                birth_date=record['birth_date'],
+                )
+            for record in records
+            ])
+
+        with_address = [record for record in records if any(record.get(field) for field in ADDRESS_FIELDS)]
+        if with_address:
+            customer_ids = dict(
+                Customer.objects
+                .filter(user_id__in=[user_ids[record['username']] for record in with_address])
+                .values_list('user_id', 'id')
+                )
+            Address.objects.bulk_create([
+                Address(
+                    customer_id=customer_ids[user_ids[record['username']]],
+                    **{field: record.get(field, '') for field in ADDRESS_FIELDS},
+                    )
+                for record in with_address
+                ])
+
+
+def onboard_customers(records, batch_size=1000, workers=None):
+    """
+    Create a user, its customer and its address, if any, for each record.
+
+    This is the bulk counterpart of signing up: every user gets exactly one
+    customer, as create_customer_profile_for_newly_created_user guarantees
+    for users saved one by one. Records are read lazily in batches.
+    Passwords are hashed on a pool of `workers` processes, and each batch
+    is written with three bulk inserts in one transaction. Records whose
+    username or email already exists, in any case, and records with a
+    malformed birth_date are skipped. Yields (created, skipped) per batch.
+    """
+    user_model = get_user_model()
+    workers = workers or os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        for batch in _batches(records, batch_size):
+            new_records = _new_records(user_model, batch)
+            password_hashes = list(executor.map(
+                make_password,
+                [record.get('password') or None for record in new_records],
+                chunksize=max(1, len(new_records) // (workers * 4)),
+                ))
+            if new_records:
+                _create_batch(user_model, new_records, password_hashes)
+
+            yield len(new_records), len(batch) - len(new_records)
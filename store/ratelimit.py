@@ -0,0 +1,18 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """Let at most `rate` calls per second through, across threads."""
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next_call = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
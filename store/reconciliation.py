@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import zarinpal
+from .models import Order, PaymentAttempt
+from .ratelimit import RateLimiter
+from .signals import order_status_changed
+
+
+def _verify(client, rate_limiter, attempt):
+    rate_limiter.wait()
+    try:
+        return attempt, client.verify_payment(attempt.amount, attempt.authority)
+    except zarinpal.ZarinpalError:
+        return attempt, None
+
+
+def _apply(verified, declined):
+    """
+    Mark the still-unpaid orders among `verified` as paid, and the `declined`
+    attempts as failed, in bulk updates. Verified attempts of orders the
+    callback has paid meanwhile are only recorded as succeeded.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        order_statuses = dict(
+            Order.objects
+            .select_for_update()
+            .filter(
+                id__in=[attempt.order_id for attempt, _ in verified],
+                status__in=[Order.ORDER_STATUS_UNPAID, Order.ORDER_STATUS_PAID],
+                )
+            .values_list('id', 'status')
+            )
+        attempts = []
+        orders = []
+        for attempt, data in verified:
+            if attempt.order_id not in order_statuses:
+                continue
+            attempt.status = PaymentAttempt.PAYMENT_STATUS_SUCCEEDED
+            attempt.ref_id = str(data.get('RefID', ''))
+            attempt.verify_data = data
+            attempt.datetime_modified = now
+            attempts.append(attempt)
+            if order_statuses[attempt.order_id] == Order.ORDER_STATUS_UNPAID:
+                orders.append(Order(
+                    id=attempt.order_id,
+                    status=Order.ORDER_STATUS_PAID,
+                    zarinpal_ref_id=attempt.ref_id,
+                    zarinpal_data=data,
+                    ))
+
+        for attempt, data in declined:
+            attempt.status = PaymentAttempt.PAYMENT_STATUS_FAILED
+            attempt.verify_data = data
+            attempt.datetime_modified = now
+            attempts.append(attempt)
+
+        PaymentAttempt.objects.bulk_update(attempts, ['status', 'ref_id', 'verify_data', 'datetime_modified'])
+        Order.objects.bulk_update(orders, ['status', 'zarinpal_ref_id', 'zarinpal_data'])
+
+        if orders:
+            order_ids = [order.id for order in orders]
+            order_status_changed.send(
+                sender=Order,
+                order_ids=order_ids,
+                from_status=Order.ORDER_STATUS_UNPAID,
+                to_status=Order.ORDER_STATUS_PAID,
+                )
+    return len(orders)
+
+
+def reconcile_payments(client=None, after_id=0, batch_size=200, concurrency=10, rate=20):
+    """
+    Verify the waiting payment attempts of unpaid orders and mark the
+    orders the gateway reports as paid.
+
+    Attempts the gateway declines are marked failed once their callback URL
+    has expired, as the customer can no longer complete them; younger ones
+    are checked again on the next run. Attempts are read in id order in
+    batches, verified concurrently on `concurrency` threads at no more than
+    `rate` calls per second, and each batch is applied in bulk updates.
+    Yields (last attempt id, checked, paid, declined, unreachable) per
+    batch; pass the last id back as `after_id` to resume.
+    """
+    client = client or zarinpal.client
+    rate_limiter = RateLimiter(rate)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            attempts = list(
+                PaymentAttempt.objects
+                .filter(
+                    status=PaymentAttempt.PAYMENT_STATUS_WAITING,
+                    order__status=Order.ORDER_STATUS_UNPAID,
+                    id__gt=after_id,
+                    )
+                .order_by('id')
+                .only('id', 'order_id', 'authority', 'amount', 'datetime_created')[:batch_size]
+                )
+            if not attempts:
+                return
+            after_id = attempts[-1].id
+
+            results = list(executor.map(lambda attempt: _verify(client, rate_limiter, attempt), attempts))
+            callback_expired_before = timezone.now() - settings.ZARINPAL_CALLBACK_MAX_AGE
+            verified = []
+            declined = []
+            for attempt, data in results:
+                if data is None:
+                    continue
+                if 'errors' not in data and data.get('Status') in [100, 101]:
+                    verified.append((attempt, data))
+                elif attempt.datetime_created < callback_expired_before:
+                    declined.append((attempt, data))
+            unreachable_count = sum(1 for _, data in results if data is None)
+
+            yield after_id, len(attempts), _apply(verified, declined), len(declined), unreachable_count
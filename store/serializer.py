@@ -1,9 +1,25 @@
+from datetime import timedelta
 from decimal import Decimal
+from django.utils import timezone
 from django.utils.text import slugify
 from django.db import transaction
+from django.db.models import Exists, OuterRef, Prefetch, prefetch_related_objects
+from django.template import Template, TemplateSyntaxError
 from rest_framework import serializers
 
-from .models import Cart, CartItem, Category, Comment, Customer, Order, OrderItem, Product
+from .models import ArchivedOrder, ArchivedOrderItem, Cart, CartItem, Category, Comment, Customer, Order, OrderItem, Product, has_waiting_payment_attempt
+
+ORDER_NOT_RETURNABLE_MESSAGE = (
+    'This order has been paid or '
+    'canceled by the customer and '
+    'cannot be returned to the '
+    'shopping cart'
+    )
+ORDER_PAYMENT_PENDING_MESSAGE = (
+    'A payment for this order is still '
+    'being processed, so it cannot be '
+    'returned to the shopping cart'
+    )
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -153,6 +169,73 @@ class CustomerSerializer(serializers.ModelSerializer):
         read_only_fields = ['user']
 
 
+class CustomerDirectorySerializer(serializers.ModelSerializer):
+    first_name = serializers.CharField(source='user.first_name', read_only=True)
+    last_name = serializers.CharField(source='user.last_name', read_only=True)
+    email = serializers.EmailField(source='user.email', read_only=True)
+    # annotated from CustomerStats by CustomerViewSet
+    order_count = serializers.IntegerField(read_only=True)
+    lifetime_spend = serializers.DecimalField(max_digits=14, decimal_places=2, read_only=True)
+    average_basket = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+    last_order_at = serializers.DateTimeField(read_only=True)
+
+    class Meta:
+        model = Customer
+        fields = [
+            'id',
+            'user',
+            'first_name',
+            'last_name',
+            'email',
+            'phone_number',
+            'birth_date',
+            'order_count',
+            'lifetime_spend',
+            'average_basket',
+            'last_order_at',
+            ]
+
+
+class PrivateEmailSerializer(serializers.Serializer):
+    subject = serializers.CharField(max_length=255)
+    body = serializers.CharField()
+
+    def validate_template(self, source):
+        try:
+            Template(source)
+        except TemplateSyntaxError as e:
+            raise serializers.ValidationError(str(e))
+        return source
+
+    def validate_subject(self, subject):
+        return self.validate_template(subject)
+
+    def validate_body(self, body):
+        return self.validate_template(body)
+
+
+class BulkPrivateEmailSerializer(PrivateEmailSerializer):
+    customer_ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        max_length=100000,
+        )
+
+    def validate_customer_ids(self, customer_ids):
+        customer_ids = set(customer_ids)
+        found_ids = set(Customer.objects.filter(id__in=customer_ids).values_list('id', flat=True))
+        if found_ids != customer_ids:
+            raise serializers.ValidationError(f'There is no customer with ids {sorted(customer_ids - found_ids)}!')
+        return sorted(customer_ids)
+
+
+class PurchasedProductSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    product_name = serializers.CharField()
+    last_purchased_at = serializers.DateTimeField()
+    total_quantity = serializers.IntegerField()
+
+
 class OrderCustomerSerializer(serializers.ModelSerializer):
     first_name = serializers.CharField(max_length=255, source='user.first_name')
     last_name = serializers.CharField(max_length=255, source='user.last_name')
@@ -178,98 +261,104 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'quantity', 'item_total_price']
 
     def get_item_total_price(self, order_item: OrderItem):
-        return order_item.product.unit_price * order_item.quantity
+        return order_item.get_cost()
+
+
+class AdminOrderHeaderSerializer(serializers.ModelSerializer):
+    customer = OrderCustomerSerializer()
+
+    class Meta:
+        model = Order
+        fields = ['id', 'customer', 'total_price', 'item_count', 'status', 'datetime_created']
+
+
+class ClientOrderHeaderSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = ['id', 'total_price', 'item_count', 'status', 'datetime_created']
 
 
 class AdminOrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
     customer = OrderCustomerSerializer()
-    total_price = serializers.SerializerMethodField()
 
     class Meta:
         model = Order
-        fields = ['id', 'customer', 'items', 'total_price', 'status', 'datetime_created']
-
-    def get_total_price(self, order: Order):
-        return sum([item.quantity * item.product.unit_price  for item in order.items.all()])
+        fields = ['id', 'customer', 'items', 'total_price', 'item_count', 'status', 'datetime_created']
 
 
 class ClientOrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
-    total_price = serializers.SerializerMethodField()
 
     class Meta:
         model = Order
-        fields = ['id', 'items', 'total_price', 'status', 'datetime_created']
+        fields = ['id', 'items', 'total_price', 'item_count', 'status', 'datetime_created']
+
+
+class ArchivedOrderItemSerializer(serializers.ModelSerializer):
+    product = OrderItemProductSerializer()
+    item_total_price = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ArchivedOrderItem
+        fields = ['id', 'product', 'quantity', 'unit_price', 'item_total_price']
+
+    def get_item_total_price(self, order_item: ArchivedOrderItem):
+        return order_item.get_cost()
 
-    def get_total_price(self, order: Order):
-        return sum([item.product.unit_price * item.quantity for item in order.items.all()])
+
+class ArchivedOrderSerializer(serializers.ModelSerializer):
+    items = ArchivedOrderItemSerializer(many=True)
+
+    class Meta:
+        model = ArchivedOrder
+        fields = ['id', 'customer', 'items', 'total_price', 'item_count', 'status', 'datetime_created']
 
 
 class OrderCreateSerializer(serializers.Serializer):
     cart_id = serializers.UUIDField()
 
     def validate_cart_id(self, cart_id):
+        # Load the cart items (with their products) once; the same rows are
+        # reused by save(), so validation costs no extra query on success.
+        self.cart_items = list(
+            CartItem.objects.select_related('product').filter(cart_id=cart_id)
+            )
 
-        if not Cart.objects.filter(id=cart_id).exists():
-            raise serializers.ValidationError('There is no cart with this cart id!')
-
-        if CartItem.objects.filter(cart_id=cart_id).count() == 0:
+        if not self.cart_items:
+            if not Cart.objects.filter(id=cart_id).exists():
+                raise serializers.ValidationError('There is no cart with this cart id!')
             raise serializers.ValidationError('Your cart is empty. Please add some product to it first!')
 
         return cart_id
 
-# ///////////////////////////////////////////////////////////////////////////////////////////////////////////////
-        # The second method:
-        # try:
-        #     if Cart.objects.prefetch_related('items').get(id=cart_id).items.count() == 0:
-        #         raise serializers.ValidationError('Your cart is empty. Please add some product to it first!')
-        # except Cart.DoesNotExist:
-        #     raise serializers.ValidationError('There is no cart with this cart id!')
-# ///////////////////////////////////////////////////////////////////////////////////////////////////////////////
-
     def save(self):
         with transaction.atomic():
             cart_id = self.validated_data['cart_id']
-            user_id = self.context['user_id']
-            customer = Customer.objects.get(user_id=user_id)
-            
-# ///////////////////////////////////////////////////////////////////////////
-            # The second method:
-            # cart_items = Cart.objects.prefetch_related('items').get(id=cart_id).items.all()
-# /////////////////////////////////////////////////////////////////////////////
-
-            cart_items = CartItem.objects.select_related('product').filter(cart_id=cart_id)
             order = Order()
-            order.customer = customer
-            order.save()
+            order.customer_id = self.context['customer_id']
 
             order_items = [
                 OrderItem(
                     order=order,
-                    product_id=cart_item.product_id,
+                    product=cart_item.product,
                     quantity=cart_item.quantity,
                     unit_price=cart_item.product.unit_price
-                ) for cart_item in cart_items
+                ) for cart_item in self.cart_items
                 ]
 
-# /////////////////////////////////////////////////////
-            # second method:
-            # order_items = list()
-            # for cart_item in cart_items:
-            #     order_item = OrderItem()
-            #     order_item.order = order
-            #     order_item.product_id = cart_item.product_id
-            #     order_item.quantity = cart_item.quantity
-            #     order_item.unit_price = cart_item.product.unit_price
-            #     order_items.append(order_item)
-# ////////////////////////////////////////////////////////
+            order.total_price = sum(item.get_cost() for item in order_items)
+            order.item_count = len(order_items)
+            order.save()
 
             OrderItem.objects.bulk_create(order_items)
 
-            Cart.objects.get(pk=cart_id).delete()
+            Cart.objects.filter(pk=cart_id).delete()
 
-            return order
+        # Not every backend (MySQL) returns the new primary keys from
+        # bulk_create, so the items are read back once for the response.
+        prefetch_related_objects([order], Prefetch('items', queryset=OrderItem.objects.select_related('product')))
+        return order
 
 
 class OrderUpdateSerializer(serializers.ModelSerializer):
@@ -277,23 +366,59 @@ class OrderUpdateSerializer(serializers.ModelSerializer):
         model = Order
         fields = ['status']
 
+    def validate_status(self, status):
+        if status != self.instance.status and status not in Order.ORDER_STATUS_TRANSITIONS[self.instance.status]:
+            raise serializers.ValidationError(
+                f'An order can not go from {self.instance.get_status_display()} to this status.'
+                )
+        return status
+
+    def update(self, instance, validated_data):
+        if 'status' not in validated_data:
+            return instance
+        Order.objects.filter(pk=instance.pk).transition_status(validated_data['status'])
+        instance.status = validated_data['status']
+        return instance
+
+
+class OrderBulkStatusSerializer(serializers.Serializer):
+    order_ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        max_length=10000,
+        )
+    status = serializers.ChoiceField(choices=Order.ORDER_STATUS)
+
+    def save(self):
+        return Order.objects\
+            .filter(id__in=self.validated_data['order_ids'])\
+            .transition_status(self.validated_data['status'])
+
 
 class OrderToCartSeializer(serializers.Serializer):
     order_id = serializers.IntegerField()
 
     def validate_order_id(self, order_id: Order):
-        if not Order.objects.filter(id=order_id).exists():
+        order = Order.objects\
+            .filter(id=order_id)\
+            .annotate(
+                has_items=Exists(OrderItem.objects.filter(order_id=OuterRef('pk'))),
+                has_waiting_payment=has_waiting_payment_attempt(),
+                )\
+            .values('status', 'has_items', 'has_waiting_payment')\
+            .first()
+
+        if order is None:
             raise serializers.ValidationError('There is no order with this order id!')
 
-        if OrderItem.objects.filter(order_id=order_id).count() == 0:
+        if not order['has_items']:
             raise serializers.ValidationError('Your order has no items!')
 
-        if Order.objects.get(id=order_id).status in ['p', 'c']:
-            raise serializers.ValidationError('This order has been paid or'
-                                              'canceled by the customer and '
-                                              'cannot be returned to the'
-                                              'shopping cart'
-                                              )
+        if order['status'] in [Order.ORDER_STATUS_PAID, Order.ORDER_STATUS_CANCELED]:
+            raise serializers.ValidationError(ORDER_NOT_RETURNABLE_MESSAGE)
+
+        if order['has_waiting_payment']:
+            raise serializers.ValidationError(ORDER_PAYMENT_PENDING_MESSAGE)
 
         return order_id
 
@@ -301,26 +426,66 @@ class OrderToCartSeializer(serializers.Serializer):
         with transaction.atomic():
             order_id = self.validated_data['order_id']
 
+            # Lock the order row so concurrent requests for the same order
+            # can't each turn it into a cart.
+            locked = Order.objects\
+                .select_for_update()\
+                .filter(id=order_id, status=Order.ORDER_STATUS_UNPAID)\
+                .annotate(has_waiting_payment=has_waiting_payment_attempt())\
+                .values_list('has_waiting_payment', flat=True)
+            locked = list(locked)
+            if not locked:
+                raise serializers.ValidationError({'order_id': [ORDER_NOT_RETURNABLE_MESSAGE]})
+            if locked[0]:
+                raise serializers.ValidationError({'order_id': [ORDER_PAYMENT_PENDING_MESSAGE]})
+
             cart = Cart()
             cart.save()
 
-            order_items = OrderItem.objects.select_related('product').filter(order_id=order_id)
+            order_items = OrderItem.objects\
+                .filter(order_id=order_id)\
+                .values_list('product_id', 'quantity')
 
-            cart_items = [
+            CartItem.objects.bulk_create([
                 CartItem(
                     cart=cart,
-                    product_id=order_item.product_id,
-                    quantity=order_item.quantity
-                ) for order_item in order_items
-            ]
+                    product_id=product_id,
+                    quantity=quantity
+                ) for product_id, quantity in order_items
+            ])
 
-            CartItem.objects.bulk_create(cart_items)
+            OrderItem.objects.filter(order_id=order_id).delete()
+            Order.objects.filter(id=order_id).delete()
 
-            order_items = [
-                OrderItem.objects.get(id=order_item.id).delete()
-                for order_item in order_items
-            ]
+            return cart
 
-            Order.objects.get(id=order_id).delete()
 
-            return cart
+class SalesAnalyticsQuerySerializer(serializers.Serializer):
+    GROUP_BY_DAY = 'day'
+    GROUP_BY_PRODUCT = 'product'
+    GROUP_BY_CATEGORY = 'category'
+
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    group_by = serializers.ChoiceField(
+        choices=[GROUP_BY_DAY, GROUP_BY_PRODUCT, GROUP_BY_CATEGORY],
+        default=GROUP_BY_DAY,
+        )
+    metric = serializers.ChoiceField(choices=['revenue', 'units', 'orders'], default='revenue')
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=10)
+    product = serializers.IntegerField(required=False)
+    category = serializers.IntegerField(required=False)
+
+    def validate(self, data):
+        data.setdefault('end', timezone.localdate())
+        data.setdefault('start', data['end'] - timedelta(days=30))
+        if data['start'] > data['end']:
+            raise serializers.ValidationError('start should be before end.')
+        return data
+
+
+class OrderExportQuerySerializer(serializers.Serializer):
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    status = serializers.ChoiceField(choices=Order.ORDER_STATUS, required=False)
+    file_format = serializers.ChoiceField(choices=['csv', 'ndjson'], default='csv')
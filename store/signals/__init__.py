@@ -1,3 +1,7 @@
 from django.dispatch import Signal
 
 order_created = Signal()
+
+# Sent once per batch of orders moved from one status to another, with
+# order_ids, from_status and to_status.
+order_status_changed = Signal()
@@ -1,11 +1,57 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.conf import settings
 
-from ..models import Customer
+from core.tasks import enqueue, task
+
+from ..analytics import apply_orders_to_sales_rollups
+from ..cache import invalidate_customer, invalidate_purchase_history
+from ..customer_stats import apply_orders_to_customer_stats
+from ..models import Customer, Order
+from . import order_status_changed
 
 
 @receiver(signal=post_save, sender=settings.AUTH_USER_MODEL)
 def create_customer_profile_for_newly_created_user(sender, instance, created, **kwargs):
     if created:
         Customer.objects.create(user=instance)
+
+
+@receiver(signal=[post_save, post_delete], sender=Customer)
+def invalidate_cached_customer(sender, instance, **kwargs):
+    invalidate_customer(instance.user_id)
+
+
+# order_status_changed is sent inside the transaction that changes the
+# statuses, so these tasks are committed with it and survive the process.
+
+task('store.apply_orders_to_sales_rollups')(apply_orders_to_sales_rollups)
+task('store.apply_orders_to_customer_stats')(apply_orders_to_customer_stats)
+
+
+@task('store.invalidate_purchase_history')
+def invalidate_purchase_history_of_customers(customer_ids):
+    invalidate_purchase_history(*customer_ids)
+
+
+@receiver(signal=order_status_changed, sender=Order)
+def invalidate_purchase_history_of_paid_orders(sender, order_ids, to_status, **kwargs):
+    if to_status == Order.ORDER_STATUS_PAID:
+        customer_ids = Order.objects.filter(id__in=order_ids).values_list('customer_id', flat=True).distinct()
+        enqueue('store.invalidate_purchase_history', customer_ids=list(customer_ids))
+
+
+@receiver(signal=order_status_changed, sender=Order)
+def update_sales_rollups(sender, order_ids, from_status, to_status, **kwargs):
+    if to_status == Order.ORDER_STATUS_PAID:
+        enqueue('store.apply_orders_to_sales_rollups', order_ids=order_ids)
+    elif from_status == Order.ORDER_STATUS_PAID:
+        enqueue('store.apply_orders_to_sales_rollups', order_ids=order_ids, sign=-1)
+
+
+@receiver(signal=order_status_changed, sender=Order)
+def update_customer_stats(sender, order_ids, from_status, to_status, **kwargs):
+    if to_status == Order.ORDER_STATUS_PAID:
+        enqueue('store.apply_orders_to_customer_stats', order_ids=order_ids)
+    elif from_status == Order.ORDER_STATUS_PAID:
+        enqueue('store.apply_orders_to_customer_stats', order_ids=order_ids, sign=-1)
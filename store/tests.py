@@ -1,3 +1,1304 @@
-from django.test import TestCase
+import asyncio
+import json
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.mail.backends import locmem
+from django.db import DatabaseError, IntegrityError, connection
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.models import Task
+from core.tasks import run_tasks
+
+from . import exports, zarinpal
+from .analytics import rebuild_sales_rollups
+from .archive import archive_orders
+from .customer_stats import rebuild_customer_stats
+from .factories import CategoryFactory, ProductFactory, UserFactory
+from .mail import queue_private_emails, send_queued_emails
+from .paginations import CustomerDirectoryPagination, EstimatedCountPaginator
+from .models import Address, ArchivedOrder, ArchivedOrderItem, Cart, CartItem, Comment, Customer, CustomerStats, DailyProductSales, DailySales, IdempotencyKey, Order, OrderItem, PaymentAttempt, PrivateEmail, Product
+from .onboarding import onboard_customers
+from .reconciliation import reconcile_payments
+from .serializer import OrderToCartSeializer
+from .signals import order_status_changed
+from .zarinpal_stub import StubZarinpalGateway
+
+
+class StoreTestCase(TestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        # Cached users, customers and permissions outlive the rolled back
+        # rows of earlier tests, and SQLite reuses their ids.
+        cache.clear()
+
+    def authenticate(self, **kwargs):
+        user = UserFactory(**kwargs)
+        self.client.force_authenticate(user)
+        return user
+
+
+class OrderCreateTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.authenticate()
+
+        category = CategoryFactory()
+        self.products = [ProductFactory(category=category, unit_price=10 + i, inventory=100) for i in range(5)]
+        self.cart = Cart.objects.create()
+        CartItem.objects.bulk_create(
+            CartItem(cart=self.cart, product=product, quantity=2)
+            for product in self.products
+            )
+
+    def test_checkout_returns_item_ids_without_bulk_insert_returning(self):
+        # as on MySQL, where bulk_create does not return primary keys
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False):
+            response = self.client.post(
+                reverse('store:order-list'),
+                {'cart_id': str(self.cart.id)},
+                format='json',
+                )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertCountEqual(
+            [item['id'] for item in response.data['items']],
+            OrderItem.objects.filter(order_id=response.data['id']).values_list('id', flat=True),
+            )
+
+    def test_checkout_runs_a_fixed_number_of_queries(self):
+        # warm the user -> customer cache
+        self.client.get(reverse('store:customer-me'))
+
+        # savepoint, items select, savepoint, order insert, items insert,
+        # cart select, cart items delete, cart delete, release savepoint,
+        # items reload, task insert, release savepoint
+        with self.assertNumQueries(12):
+            response = self.client.post(
+                reverse('store:order-list'),
+                {'cart_id': str(self.cart.id)},
+                format='json',
+                )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['items']), len(self.products))
+        self.assertEqual(response.data['total_price'], sum(2 * p.unit_price for p in self.products))
+        self.assertFalse(Cart.objects.filter(id=self.cart.id).exists())
+        self.assertEqual(OrderItem.objects.filter(order_id=response.data['id']).count(), 5)
+        self.assertNotIn(None, [item['id'] for item in response.data['items']])
+        self.assertTrue(Task.objects.filter(name='core.after_order_created', payload={'order_id': response.data['id']}).exists())
+
+    def test_checkout_is_rolled_back_if_its_task_is_not_enqueued(self):
+        with mock.patch('core.signals.enqueue', side_effect=DatabaseError('lost connection')):
+            with self.assertRaises(DatabaseError):
+                self.client.post(
+                    reverse('store:order-list'),
+                    {'cart_id': str(self.cart.id)},
+                    format='json',
+                    )
+
+        self.assertFalse(Order.objects.exists())
+        self.assertTrue(Cart.objects.filter(id=self.cart.id).exists())
+
+    def test_empty_cart_is_rejected(self):
+        empty_cart = Cart.objects.create()
+
+        response = self.client.post(
+            reverse('store:order-list'),
+            {'cart_id': str(empty_cart.id)},
+            format='json',
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Order.objects.exists())
+
+    def test_missing_cart_is_rejected(self):
+        response = self.client.post(
+            reverse('store:order-list'),
+            {'cart_id': '00000000-0000-0000-0000-000000000000'},
+            format='json',
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_retried_checkout_with_idempotency_key_is_replayed(self):
+        first = self.client.post(
+            reverse('store:order-list'),
+            {'cart_id': str(self.cart.id)},
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='checkout-1',
+            )
+        retry = self.client.post(
+            reverse('store:order-list'),
+            {'cart_id': str(self.cart.id)},
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='checkout-1',
+            )
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_retry_of_a_running_checkout_is_turned_away_at_once(self):
+        IdempotencyKey.objects.create(
+            user=self.user,
+            key='checkout-1',
+            request_method='POST',
+            request_path=reverse('store:order-list'),
+            expires_at=timezone.now() + timedelta(hours=1),
+            )
+
+        started = time.perf_counter()
+        response = self.client.post(
+            reverse('store:order-list'),
+            {'cart_id': str(self.cart.id)},
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='checkout-1',
+            )
+
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(Order.objects.exists())
+
+    def test_retry_takes_over_a_key_whose_request_died(self):
+        record = IdempotencyKey.objects.create(
+            user=self.user,
+            key='checkout-1',
+            request_method='POST',
+            request_path=reverse('store:order-list'),
+            expires_at=timezone.now() + timedelta(hours=1),
+            )
+        IdempotencyKey.objects.filter(id=record.id).update(
+            datetime_created=timezone.now() - settings.IDEMPOTENCY_KEY_LEASE - timedelta(seconds=1),
+            )
+
+        response = self.client.post(
+            reverse('store:order-list'),
+            {'cart_id': str(self.cart.id)},
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='checkout-1',
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        record.refresh_from_db()
+        self.assertEqual(record.response_status, status.HTTP_201_CREATED)
+
+    def test_retry_losing_the_race_to_a_failed_checkout_gets_a_conflict(self):
+        # The first request inserted its key, then failed and deleted it.
+        with mock.patch.object(IdempotencyKey.objects, 'create', side_effect=IntegrityError):
+            response = self.client.post(
+                reverse('store:order-list'),
+                {'cart_id': str(self.cart.id)},
+                format='json',
+                HTTP_IDEMPOTENCY_KEY='checkout-1',
+                )
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderToCartTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        user = self.authenticate()
+
+        category = CategoryFactory()
+        self.order = Order.objects.create(customer=user.customer)
+        OrderItem.objects.bulk_create(
+            OrderItem(order=self.order, product=ProductFactory(category=category), quantity=i + 1, unit_price=10)
+            for i in range(5)
+            )
+
+    def test_return_to_cart_runs_a_fixed_number_of_queries(self):
+        # 11 for the conversion itself and 3 to render the new cart,
+        # independent of the number of items.
+        with self.assertNumQueries(14):
+            response = self.client.post(
+                reverse('store:order_to_cart'),
+                {'order_id': self.order.id},
+                format='json',
+                )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            sorted(item['quantity'] for item in response.data['items']),
+            [1, 2, 3, 4, 5],
+            )
+        self.assertFalse(Order.objects.filter(id=self.order.id).exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_paid_order_cannot_be_returned_to_cart(self):
+        Order.objects.filter(id=self.order.id).update(status=Order.ORDER_STATUS_PAID)
+
+        response = self.client.post(
+            reverse('store:order_to_cart'),
+            {'order_id': self.order.id},
+            format='json',
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_order_with_a_waiting_payment_cannot_be_returned_to_cart(self):
+        PaymentAttempt.start(self.order, amount=500000, data={'Status': 100, 'Authority': 'A' * 36})
+
+        response = self.client.post(
+            reverse('store:order_to_cart'),
+            {'order_id': self.order.id},
+            format='json',
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(Order.objects.filter(id=self.order.id).exists())
+        self.assertFalse(Cart.objects.exists())
+
+    def test_payment_started_after_validation_is_caught_under_the_lock(self):
+        serializer = OrderToCartSeializer(data={'order_id': self.order.id})
+        self.assertTrue(serializer.is_valid())
+        PaymentAttempt.start(self.order, amount=500000, data={'Status': 100, 'Authority': 'A' * 36})
+
+        with self.assertRaises(ValidationError):
+            serializer.save()
+        self.assertEqual(OrderItem.objects.filter(order_id=self.order.id).count(), 5)
+        self.assertFalse(Cart.objects.exists())
+
+
+class OrderListTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.authenticate(is_staff=True)
+
+        customer = UserFactory(email='customer@example.com').customer
+        Order.objects.bulk_create(
+            Order(customer=customer, total_price=price, status=Order.ORDER_STATUS_PAID)
+            for price in range(0, 300, 10)
+            )
+
+    def test_order_headers_are_paginated_and_filtered(self):
+        # page count and page select, no items prefetch
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                reverse('store:order-list'),
+                {'items': 'false', 'total_price__gte': 100, 'status': 'p'},
+                )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 20)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertNotIn('items', response.data['results'][0])
+
+    def test_bulk_status_applies_allowed_transitions_only(self):
+        unpaid = Order.objects.create(customer=Order.objects.first().customer)
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        order_status_changed.connect(receiver)
+        self.addCleanup(order_status_changed.disconnect, receiver)
+
+        canceled_ids = list(Order.objects.exclude(id=unpaid.id).order_by('id').values_list('id', flat=True)[:5])
+        Order.objects.filter(id__in=canceled_ids).update(status=Order.ORDER_STATUS_CANCELED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('store:order-bulk-status'),
+                {'order_ids': canceled_ids + [unpaid.id], 'status': Order.ORDER_STATUS_PAID},
+                format='json',
+                )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['updated'], 1)
+        self.assertEqual(response.data['skipped'], 5)
+        self.assertEqual(Order.objects.get(id=unpaid.id).status, Order.ORDER_STATUS_PAID)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0]['order_ids'], [unpaid.id])
+
+    def test_empty_status_update_leaves_the_order_unchanged(self):
+        order = Order.objects.first()
+        response = self.client.patch(reverse('store:order-detail', args=[order.id]), {}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Order.objects.get(id=order.id).status, Order.ORDER_STATUS_PAID)
+
+    def test_admin_action_reports_the_selected_count(self):
+        self.client.force_login(UserFactory(is_staff=True, is_superuser=True))
+        unpaid = Order.objects.create(customer=Order.objects.first().customer)
+
+        response = self.client.post(
+            reverse('admin:store_order_changelist') + f'?status__exact={Order.ORDER_STATUS_UNPAID}',
+            {'action': 'mark_paid', '_selected_action': [unpaid.id]},
+            follow=True,
+            )
+
+        self.assertEqual(Order.objects.get(id=unpaid.id).status, Order.ORDER_STATUS_PAID)
+        self.assertEqual([str(message) for message in response.context['messages']], ['1 of 1 selected orders marked as paid.'])
+
+    def test_export_streams_hot_and_archived_order_items(self):
+        product = ProductFactory()
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=product, quantity=1, unit_price=10)
+            for order in Order.objects.all()
+            )
+
+        order_ids = list(Order.objects.order_by('id').values_list('id', flat=True))
+        Order.objects.filter(id__in=order_ids[::2]).update(datetime_created=timezone.now() - timedelta(days=2))
+        archive_orders(created_before=timezone.now() - timedelta(days=1))
+
+        today = timezone.localdate().isoformat()
+        response = self.client.get(reverse('store:order_export'), {'file_format': 'ndjson', 'status': 'p'})
+        # keyset chunks of 5 over 15 hot and 15 archived items; the fourth
+        # chunk of each comes back empty
+        with mock.patch.object(exports, 'EXPORT_CHUNK_SIZE', 5):
+            with self.assertNumQueries(4 + 4):
+                lines = b''.join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row['order_id'] for row in rows], order_ids)
+        self.assertEqual(rows[0]['customer_email'], 'customer@example.com')
+
+        response = self.client.get(reverse('store:order_export'), {'file_format': 'ndjson', 'start': today, 'end': today})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 15)
+
+
+class CustomerMeTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.authenticate()
+
+    def test_customer_is_cached_until_saved(self):
+        url = reverse('store:customer-me')
+        self.client.get(url)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data['id'], self.user.customer.id)
+
+        response = self.client.put(url, {'phone_number': '09120000000'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data['phone_number'], '09120000000')
+
+
+class CustomerDirectoryTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.authenticate(is_staff=True, first_name='Staff', last_name='Member')
+
+        for i, (first_name, last_name) in enumerate([('Ali', 'Ahmadi'), ('Reza', 'Alizadeh'), ('Sara', 'Karimali')]):
+            user = UserFactory(username=f'customer{i}', first_name=first_name, last_name=last_name)
+            Customer.objects.filter(user=user).update(phone_number=f'0912000000{i}')
+
+    def test_prefix_search_on_name_email_and_phone(self):
+        url = reverse('store:customer-list')
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'search': 'ali'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(customer['first_name'] for customer in response.data['results']),
+            ['Ali', 'Reza'],
+            )
+
+        response = self.client.get(url, {'search': '09120000002'})
+        self.assertEqual([customer['last_name'] for customer in response.data['results']], ['Karimali'])
+
+        response = self.client.get(url, {'search': 'customer1@'})
+        self.assertEqual([customer['email'] for customer in response.data['results']], ['customer1@example.com'])
+
+    def test_directory_is_paginated(self):
+        response = self.client.get(reverse('store:customer-list'))
+        self.assertEqual(len(response.data['results']), 4)
+        self.assertIn('next', response.data)
+
+
+class OnboardCustomersTests(StoreTestCase):
+    def test_every_new_user_gets_a_customer(self):
+        UserFactory(username='taken')
+        records = [
+            {'username': f'user{i}', 'email': f'user{i}@example.com', 'password': 'secret-pass', 'phone_number': f'0912{i}'}
+            for i in range(5)
+            ]
+        records[0].update(province='Tehran', city='Tehran', street='Enghelab')
+        records += [
+            {'username': 'taken', 'email': 'other@example.com', 'password': 'secret-pass'},
+            {'username': 'other', 'email': 'user1@example.com', 'password': 'secret-pass'},
+            ]
+
+        batches = list(onboard_customers(records, batch_size=4, workers=2))
+
+        self.assertEqual(batches, [(4, 0), (1, 2)])
+        users = get_user_model().objects.filter(username__startswith='user').select_related('customer')
+        self.assertEqual(len(users), 5)
+        for user in users:
+            self.assertTrue(user.check_password('secret-pass'))
+            self.assertEqual(user.customer.phone_number, f'0912{user.username[-1]}')
+        self.assertEqual(Address.objects.get().customer.user.username, 'user0')
+
+    def test_case_duplicates_and_malformed_birth_dates_are_skipped(self):
+        records = [
+            {'username': 'Sara', 'email': 'sara@example.com', 'birth_date': '1990-05-01'},
+            {'username': 'sara', 'email': 'sara2@example.com'},
+            {'username': 'reza', 'email': 'SARA@example.com'},
+            {'username': 'nima', 'email': 'nima@example.com', 'birth_date': '1990-13-01'},
+            ]
+
+        batches = list(onboard_customers(records, workers=1))
+
+        self.assertEqual(batches, [(1, 3)])
+        customer = Customer.objects.select_related('user').get()
+        self.assertEqual((customer.user.username, customer.birth_date), ('Sara', date(1990, 5, 1)))
+
+
+class PurchaseHistoryTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.authenticate().customer
+
+        self.product = ProductFactory()
+        for status_ in [Order.ORDER_STATUS_PAID, Order.ORDER_STATUS_PAID, Order.ORDER_STATUS_UNPAID]:
+            order = Order.objects.create(customer=self.customer, status=status_)
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, unit_price=10)
+
+    def test_purchases_are_grouped_and_cached_until_next_paid_order(self):
+        url = reverse('store:customer-purchases')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['product_id'], self.product.id)
+        self.assertEqual(response.data['results'][0]['total_quantity'], 4)
+
+        # the customer and its history both come from the cache
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        order = Order.objects.create(customer=self.customer)
+        OrderItem.objects.create(order=order, product=self.product, quantity=1, unit_price=10)
+        Order.objects.filter(id=order.id).transition_status(Order.ORDER_STATUS_PAID)
+        run_tasks()
+
+        response = self.client.get(url)
+        self.assertEqual(response.data['results'][0]['total_quantity'], 5)
+
+    def test_archived_purchases_are_kept(self):
+        other_product = ProductFactory()
+        order = Order.objects.create(customer=self.customer, status=Order.ORDER_STATUS_PAID)
+        OrderItem.objects.create(order=order, product=other_product, quantity=3, unit_price=10)
+        newest = Order.objects.filter(id=order.id).values_list('datetime_created', flat=True).get()
+        Order.objects.exclude(id=order.id).update(datetime_created=timezone.now() - timedelta(days=2))
+        archive_orders(created_before=timezone.now() - timedelta(days=1))
+
+        response = self.client.get(reverse('store:customer-purchases'))
+
+        self.assertEqual(
+            [(row['product_id'], row['total_quantity']) for row in response.data['results']],
+            [(other_product.id, 3), (self.product.id, 4)],
+            )
+        self.assertEqual(response.data['results'][0]['last_purchased_at'], newest.isoformat().replace('+00:00', 'Z'))
+
+
+class SalesAnalyticsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.authenticate(is_staff=True)
+
+        customer = UserFactory().customer
+        category = CategoryFactory()
+        self.products = ProductFactory.create_batch(3, category=category)
+        self.orders = []
+        for quantity in range(1, 4):
+            order = Order.objects.create(customer=customer)
+            OrderItem.objects.bulk_create(
+                OrderItem(order=order, product=product, quantity=quantity, unit_price=10)
+                for product in self.products[:quantity]
+                )
+            self.orders.append(order)
+
+    def test_status_changes_enqueue_their_side_effects_in_the_same_transaction(self):
+        Order.objects.filter(id=self.orders[0].id).transition_status(Order.ORDER_STATUS_PAID)
+        self.assertEqual(
+            sorted(Task.objects.values_list('name', 'payload__order_ids')),
+            [
+                ('store.apply_orders_to_customer_stats', [self.orders[0].id]),
+                ('store.apply_orders_to_sales_rollups', [self.orders[0].id]),
+                ('store.invalidate_purchase_history', None),
+                ],
+            )
+
+        with mock.patch('store.signals.handlers.enqueue', side_effect=DatabaseError('lost connection')):
+            with self.assertRaises(DatabaseError):
+                Order.objects.filter(id=self.orders[0].id).transition_status(Order.ORDER_STATUS_CANCELED)
+        self.assertEqual(Order.objects.get(id=self.orders[0].id).status, Order.ORDER_STATUS_PAID)
+
+    def test_rollups_follow_paid_and_canceled_orders(self):
+        order_ids = [order.id for order in self.orders]
+        Order.objects.filter(id__in=order_ids).transition_status(Order.ORDER_STATUS_PAID)
+        run_tasks()
+        Order.objects.filter(id=order_ids[0]).transition_status(Order.ORDER_STATUS_CANCELED)
+        run_tasks()
+
+        incremental = list(DailyProductSales.objects.order_by('product_id').values('product_id', 'revenue', 'units', 'orders'))
+        today = timezone.localdate()
+        rebuild_sales_rollups(today, today)
+        rebuilt = list(DailyProductSales.objects.order_by('product_id').values('product_id', 'revenue', 'units', 'orders'))
+        self.assertEqual(incremental, rebuilt)
+
+        response = self.client.get(
+            reverse('store:sales_analytics'),
+            {'group_by': 'product', 'metric': 'units', 'limit': 2},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(row['product_id'], row['total_units']) for row in response.data['results']],
+            [(self.products[0].id, 5), (self.products[1].id, 5)],
+            )
+
+        response = self.client.get(reverse('store:sales_analytics'))
+        self.assertEqual(response.data['results'][0]['orders'], 2)
+        self.assertEqual(response.data['results'][0]['revenue'], 130)
+
+
+class ArchiveOrdersTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = UserFactory().customer
+        self.products = ProductFactory.create_batch(2)
+        self.created = timezone.now() - timedelta(days=2)
+
+        self.orders = []
+        for status_ in [Order.ORDER_STATUS_PAID] * 4 + [Order.ORDER_STATUS_CANCELED, Order.ORDER_STATUS_UNPAID]:
+            order = Order.objects.create(customer=self.customer, status=status_, total_price=20, item_count=2)
+            OrderItem.objects.bulk_create(
+                OrderItem(order=order, product=product, quantity=1, unit_price=10) for product in self.products
+                )
+            self.orders.append(order)
+        Order.objects.update(datetime_created=self.created)
+        self.recent = Order.objects.create(customer=self.customer, status=Order.ORDER_STATUS_PAID)
+
+    def test_old_paid_and_canceled_orders_are_moved_in_batches(self):
+        item_rows = list(OrderItem.objects.filter(order__in=self.orders[:5]).order_by('id').values_list(
+            'id', 'order_id', 'product_id', 'quantity', 'unit_price',
+            ))
+
+        with CaptureQueriesContext(connection) as queries:
+            archived_count = archive_orders(created_before=timezone.now() - timedelta(days=1), batch_size=2)
+
+        self.assertEqual(archived_count, 5)
+        # one bulk insert of orders per batch of 2
+        self.assertEqual(sum(query['sql'].startswith('INSERT INTO "store_archivedorder" ') for query in queries), 3)
+        self.assertEqual(
+            sorted(ArchivedOrder.objects.values_list('id', flat=True)),
+            [order.id for order in self.orders[:5]],
+            )
+        self.assertEqual(ArchivedOrder.objects.get(id=self.orders[0].id).datetime_created, self.created)
+        self.assertEqual(
+            list(ArchivedOrderItem.objects.order_by('id').values_list('id', 'order_id', 'product_id', 'quantity', 'unit_price')),
+            item_rows,
+            )
+        self.assertEqual(
+            sorted(Order.objects.values_list('id', flat=True)),
+            [self.orders[5].id, self.recent.id],
+            )
+        self.assertFalse(OrderItem.objects.filter(order_id__in=[order.id for order in self.orders[:5]]).exists())
+
+    def test_archived_orders_are_kept_in_sales_rollups(self):
+        archive_orders(created_before=timezone.now() - timedelta(days=1))
+
+        day = timezone.localdate(self.created)
+        rebuild_sales_rollups(day, day)
+        self.assertEqual(
+            list(DailySales.objects.values('date', 'revenue', 'units', 'orders')),
+            [{'date': day, 'revenue': 80, 'units': 8, 'orders': 4}],
+            )
+        self.assertEqual(
+            list(DailyProductSales.objects.order_by('product_id').values_list('product_id', 'units')),
+            [(product.id, 4) for product in self.products],
+            )
+
+
+class ExpireUnpaidOrdersTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = UserFactory().customer
+        self.products = ProductFactory.create_batch(2, inventory=10)
+        self.expired = []
+        for quantity in range(1, 6):
+            order = Order.objects.create(customer=self.customer, total_price=20, item_count=2)
+            OrderItem.objects.bulk_create(
+                OrderItem(order=order, product=product, quantity=quantity, unit_price=10) for product in self.products
+                )
+            self.expired.append(order)
+        self.paid = Order.objects.create(customer=self.customer, status=Order.ORDER_STATUS_PAID)
+        Order.objects.update(datetime_created=timezone.now() - settings.UNPAID_ORDER_TTL - timedelta(minutes=1))
+        self.fresh = Order.objects.create(customer=self.customer, total_price=10)
+        Order.objects.filter(id=self.fresh.id).update(
+            datetime_created=timezone.now() - settings.UNPAID_ORDER_TTL + timedelta(minutes=1),
+            )
+
+    def test_orders_past_the_ttl_are_canceled_in_batches(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs['order_ids'])
+
+        order_status_changed.connect(receiver)
+        self.addCleanup(order_status_changed.disconnect, receiver)
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            call_command('expire_unpaid_orders', batch_size=2, restock=True, stdout=out)
+
+        self.assertEqual(out.getvalue(), "Canceled 5 unpaid orders.\n")
+        self.assertEqual(
+            dict(Order.objects.values_list('id', 'status')),
+            {
+                **{order.id: Order.ORDER_STATUS_CANCELED for order in self.expired},
+                self.paid.id: Order.ORDER_STATUS_PAID,
+                self.fresh.id: Order.ORDER_STATUS_UNPAID,
+                },
+            )
+        # one signal per batch of 2
+        self.assertEqual(received, [[order.id for order in self.expired[i:i + 2]] for i in range(0, 5, 2)])
+        # one aggregated inventory UPDATE per batch
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "store_product" ') for query in queries), 3)
+        self.assertEqual(
+            list(Product.objects.order_by('id').values_list('inventory', flat=True)),
+            [10 + 15, 10 + 15],
+            )
+
+    def test_inventory_is_kept_without_restock(self):
+        Order.unpaid_orders.expire(created_before=timezone.now() - settings.UNPAID_ORDER_TTL)
+
+        self.assertEqual(Order.objects.filter(status=Order.ORDER_STATUS_CANCELED).count(), 5)
+        self.assertEqual(list(Product.objects.values_list('inventory', flat=True)), [10, 10])
+
+    def test_orders_with_a_waiting_attempt_are_skipped(self):
+        PaymentAttempt.start(self.expired[0], amount=500000, data={'Status': 100, 'Authority': 'A' * 36})
+
+        expired_count = Order.unpaid_orders.expire(created_before=timezone.now() - settings.UNPAID_ORDER_TTL)
+
+        self.assertEqual(expired_count, 4)
+        self.assertEqual(Order.objects.get(id=self.expired[0].id).status, Order.ORDER_STATUS_UNPAID)
+
+
+class CustomerStatsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.staff = self.authenticate(is_staff=True)
+
+        self.customers = [user.customer for user in UserFactory.create_batch(2)]
+        self.orders = [
+            Order.objects.create(customer=self.customers[0], total_price=10),
+            Order.objects.create(customer=self.customers[0], total_price=30),
+            Order.objects.create(customer=self.customers[1], total_price=5),
+            ]
+
+    def stats(self):
+        return list(
+            CustomerStats.objects
+            .order_by('customer_id')
+            .values('customer_id', 'order_count', 'lifetime_spend', 'average_basket', 'last_order_at')
+            )
+
+    def test_stats_follow_paid_and_canceled_orders(self):
+        Order.objects.filter(id__in=[order.id for order in self.orders]).transition_status(Order.ORDER_STATUS_PAID)
+        run_tasks()
+
+        stats = CustomerStats.objects.get(customer=self.customers[0])
+        self.assertEqual((stats.order_count, stats.lifetime_spend, stats.average_basket), (2, 40, 20))
+        self.assertEqual(stats.last_order_at, self.orders[1].datetime_created)
+
+        Order.objects.filter(id=self.orders[1].id).transition_status(Order.ORDER_STATUS_CANCELED)
+        run_tasks()
+
+        stats.refresh_from_db()
+        self.assertEqual((stats.order_count, stats.lifetime_spend, stats.average_basket), (1, 10, 10))
+        self.assertEqual(stats.last_order_at, self.orders[0].datetime_created)
+
+        incremental = self.stats()
+        list(rebuild_customer_stats(batch_size=1))
+        self.assertEqual(incremental, self.stats())
+
+    def test_directory_sorts_and_filters_on_stats(self):
+        Order.objects.filter(id__in=[order.id for order in self.orders]).transition_status(Order.ORDER_STATUS_PAID)
+        run_tasks()
+        url = reverse('store:customer-list')
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'ordering': '-lifetime_spend'})
+        self.assertEqual(
+            [(customer['id'], customer['order_count']) for customer in response.data['results']],
+            [(self.customers[0].id, 2), (self.customers[1].id, 1), (self.staff.customer.id, 0)],
+            )
+
+        response = self.client.get(url, {'stats__lifetime_spend__gte': 10})
+        self.assertEqual([customer['id'] for customer in response.data['results']], [self.customers[0].id])
+
+    def test_directory_pages_through_tied_stats(self):
+        Order.objects.filter(id=self.orders[2].id).transition_status(Order.ORDER_STATUS_PAID)
+        run_tasks()
+        UserFactory.create_batch(4)
+        expected = list(
+            Customer.objects
+            .annotate(spend=Coalesce('stats__lifetime_spend', Value(Decimal(0))))
+            .order_by('-spend', '-id')
+            .values_list('id', flat=True)
+            )
+
+        seen = []
+        pages = []
+        url = reverse('store:customer-list') + '?ordering=-lifetime_spend'
+        with mock.patch.object(CustomerDirectoryPagination, 'page_size', 2):
+            while url:
+                response = self.client.get(url)
+                pages.append(response)
+                seen += [customer['id'] for customer in response.data['results']]
+                url = response.data['next']
+
+            self.assertEqual(seen, expected)
+            response = self.client.get(pages[-1].data['previous'])
+        self.assertEqual(response.data['results'], pages[-2].data['results'])
+
+    def test_stats_keep_archived_orders(self):
+        Order.objects.filter(id__in=[order.id for order in self.orders]).transition_status(Order.ORDER_STATUS_PAID)
+        run_tasks()
+        Order.objects.filter(id=self.orders[0].id).update(datetime_created=timezone.now() - timedelta(days=2))
+        archive_orders(created_before=timezone.now() - timedelta(days=1))
+
+        Order.objects.filter(id=self.orders[1].id).transition_status(Order.ORDER_STATUS_CANCELED)
+        run_tasks()
+        stats = CustomerStats.objects.get(customer=self.customers[0])
+        self.assertEqual((stats.order_count, stats.lifetime_spend), (1, 10))
+        self.assertEqual(stats.last_order_at, ArchivedOrder.objects.get(id=self.orders[0].id).datetime_created)
+
+        incremental = self.stats()
+        list(rebuild_customer_stats())
+        self.assertEqual(incremental, self.stats())
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        if any(address.startswith('flaky') for message in messages for address in message.to):
+            raise ConnectionError('SMTP server hung up')
+        return super().send_messages(messages)
+
+
+class DyingEmailBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        # The worker is killed mid-send, before it can record the result.
+        raise SystemExit
+
+
+class PrivateEmailTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        staff = UserFactory(is_staff=True)
+        staff.user_permissions.add(Permission.objects.get(codename='send_private_email'))
+        self.client.force_authenticate(get_user_model().objects.get(id=staff.id))
+
+        self.customers = [
+            UserFactory(username=username, first_name=username.title()).customer
+            for username in ['ali', 'flaky']
+            ]
+
+    def test_emails_are_queued_rendered_and_sent_in_batches(self):
+        response = self.client.post(
+            reverse('store:customer-send-private-emails'),
+            {'customer_ids': [customer.id for customer in self.customers], 'subject': 'Sale', 'body': 'Hi {{ user.first_name }}'},
+            format='json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['queued'], 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(send_queued_emails(), (2, 0))
+        self.assertEqual(sorted(message.body for message in mail.outbox), ['Hi Ali', 'Hi Flaky'])
+        self.assertIsNone(send_queued_emails())
+
+    def test_failed_emails_are_retried_then_given_up(self):
+        response = self.client.post(
+            reverse('store:customer-send-private-email', args=[self.customers[1].id]),
+            {'subject': 'Hello', 'body': 'Hi'},
+            format='json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        email = PrivateEmail.objects.get(id=response.data['id'])
+
+        self.assertEqual(send_queued_emails(connection=FlakyEmailBackend(), max_attempts=2), (0, 0))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (PrivateEmail.EMAIL_STATUS_QUEUED, 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+
+        PrivateEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_queued_emails(connection=FlakyEmailBackend(), max_attempts=2), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual(email.status, PrivateEmail.EMAIL_STATUS_FAILED)
+        self.assertEqual(email.last_error, 'SMTP server hung up')
+
+    def test_emails_are_leased_before_sending(self):
+        email = queue_private_emails([self.customers[0].id], 'Hello', 'Hi')[0]
+
+        with self.assertRaises(SystemExit):
+            send_queued_emails(connection=DyingEmailBackend(), max_attempts=2)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (PrivateEmail.EMAIL_STATUS_QUEUED, 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertIsNone(send_queued_emails())
+
+        PrivateEmail.objects.update(next_attempt_at=timezone.now())
+        with self.assertRaises(SystemExit):
+            send_queued_emails(connection=DyingEmailBackend(), max_attempts=2)
+
+        PrivateEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_queued_emails(max_attempts=2), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (PrivateEmail.EMAIL_STATUS_FAILED, 2))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_templates_are_validated(self):
+        response = self.client.post(
+            reverse('store:customer-send-private-email', args=[self.customers[0].id]),
+            {'subject': 'Hello', 'body': 'Hi {% if %}'},
+            format='json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductAdminTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(UserFactory(is_staff=True, is_superuser=True))
+
+        category = CategoryFactory()
+        self.products = [ProductFactory(category=category, inventory=i) for i in range(15)]
+        Comment.objects.bulk_create(
+            Comment(product=self.products[-1], name='Reader', body='Nice')
+            for _ in range(3)
+            )
+
+    def test_changelist_counts_comments_per_page_without_prefetching(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:store_product_changelist'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.context['cl'].result_count, 15)
+        self.assertIsNone(response.context['cl'].full_result_count)
+        self.assertEqual([product.comments_count for product in response.context['cl'].result_list][:2], [3, 0])
+        self.assertFalse(any(query['sql'].startswith('SELECT "store_comment"') for query in queries))
+
+    def test_filtered_changelist_is_counted_exactly(self):
+        response = self.client.get(reverse('admin:store_product_changelist'), {'inventory': '<3'})
+
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def test_unfiltered_count_uses_table_statistics(self):
+        paginator = EstimatedCountPaginator(Product.objects.order_by('-id'), 10)
+        with mock.patch('store.paginations.estimated_count', return_value=10_000_000):
+            self.assertEqual(paginator.count, 10_000_000)
+
+        paginator = EstimatedCountPaginator(Product.objects.filter(inventory__lt=3).order_by('-id'), 10)
+        with mock.patch('store.paginations.estimated_count', return_value=10_000_000):
+            self.assertEqual(paginator.count, 3)
+
+
+class OrderAdminTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(UserFactory(is_staff=True, is_superuser=True))
+
+        self.products = ProductFactory.create_batch(3)
+        self.order = Order.objects.create(customer=UserFactory().customer)
+        self.items = OrderItem.objects.bulk_create(
+            OrderItem(order=self.order, product=product, quantity=2, unit_price=10) for product in self.products
+            )
+        self.order.update_totals()
+
+    def assertTotals(self, total_price, item_count):
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.total_price, self.order.item_count), (total_price, item_count))
+
+    def test_update_totals_sums_the_items(self):
+        self.assertTotals(60, 3)
+
+        OrderItem.objects.filter(id=self.items[0].id).update(quantity=5)
+        OrderItem.objects.filter(id=self.items[1].id).delete()
+        self.order.update_totals()
+        self.assertTotals(70, 2)
+
+        self.order.items.all().delete()
+        self.order.update_totals()
+        self.assertTotals(0, 0)
+
+    def change_form_data(self):
+        data = {
+            'customer': self.order.customer_id,
+            'status': self.order.status,
+            'zarinpal_ref_id': '',
+            'items-TOTAL_FORMS': 3,
+            'items-INITIAL_FORMS': 3,
+            'items-MIN_NUM_FORMS': 0,
+            'items-MAX_NUM_FORMS': 1000,
+            }
+        for i, item in enumerate(self.items):
+            data.update({
+                f'items-{i}-id': item.id,
+                f'items-{i}-order': self.order.id,
+                f'items-{i}-product': item.product_id,
+                f'items-{i}-quantity': 2,
+                f'items-{i}-unit_price': 10,
+                })
+        data['items-0-quantity'] = 4
+        data['items-2-DELETE'] = 'on'
+        return data
+
+    def test_inline_edits_and_deletes_update_the_totals(self):
+        response = self.client.post(reverse('admin:store_order_change', args=[self.order.id]), self.change_form_data())
+
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertTotals(60, 2)
+
+    def test_status_change_is_signalled_after_the_item_edits(self):
+        totals_at_signal = []
+
+        def receiver(sender, order_ids, **kwargs):
+            totals_at_signal.append(Order.objects.values_list('total_price', 'item_count').get(id__in=order_ids))
+
+        order_status_changed.connect(receiver)
+        self.addCleanup(order_status_changed.disconnect, receiver)
+
+        data = {**self.change_form_data(), 'status': Order.ORDER_STATUS_PAID}
+        response = self.client.post(reverse('admin:store_order_change', args=[self.order.id]), data)
+        run_tasks()
+
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(totals_at_signal, [(60, 2)])
+        self.assertEqual(DailySales.objects.values_list('revenue', 'units').get(), (60, 6))
+        self.assertEqual(CustomerStats.objects.get(customer_id=self.order.customer_id).lifetime_spend, 60)
+
+    def test_order_item_admin_edits_and_deletes_update_the_totals(self):
+        response = self.client.post(
+            reverse('admin:store_orderitem_change', args=[self.items[0].id]),
+            {'order': self.order.id, 'product': self.products[0].id, 'quantity': 3, 'unit_price': 10},
+            )
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertTotals(70, 3)
+
+        response = self.client.post(reverse('admin:store_orderitem_delete', args=[self.items[1].id]), {'post': 'yes'})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertTotals(50, 2)
+
+        response = self.client.post(reverse('admin:store_orderitem_changelist'), {
+            'action': 'delete_selected',
+            '_selected_action': [self.items[0].id, self.items[2].id],
+            'post': 'yes',
+            })
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertTotals(0, 0)
+
+
+class ZarinpalClientTests(SimpleTestCase):
+    def setUp(self):
+        self.gateway = StubZarinpalGateway().start()
+        self.addCleanup(self.gateway.stop)
+        self.client = zarinpal.ZarinpalClient(
+            'merchant',
+            request_url=self.gateway.request_url,
+            verify_url=self.gateway.verify_url,
+            startpay_url=self.gateway.startpay_url,
+            timeout=(1, 0.5),
+            backoff_factor=0,
+            breaker=zarinpal.CircuitBreaker(failure_threshold=3, reset_timeout=60),
+            )
+
+    def test_verify_is_retried_after_gateway_errors(self):
+        authority = self.client.request_payment(1000, 'test', 'http://testserver/verify')['Authority']
+        self.gateway.fail_next = 2
+
+        data = self.client.verify_payment(1000, authority)
+
+        self.assertEqual(data['Status'], 100)
+        self.assertEqual(len(self.gateway.calls), 4)
+
+    def test_payment_request_is_not_retried_and_times_out(self):
+        self.gateway.latency = 1
+
+        with self.assertRaises(zarinpal.ZarinpalUnavailable):
+            self.client.request_payment(1000, 'test', 'http://testserver/verify')
+
+        self.assertEqual(len(self.gateway.calls), 1)
+
+    def test_open_circuit_fails_fast(self):
+        self.gateway.fail_next = 3
+        with self.assertRaises(zarinpal.ZarinpalUnavailable):
+            self.client.verify_payment(1000, 'A1')
+
+        with self.assertRaises(zarinpal.ZarinpalUnavailable):
+            self.client.request_payment(1000, 'test', 'http://testserver/verify')
+
+        self.assertEqual(len(self.gateway.calls), 3)
+
+
+    async def test_cancelled_trial_does_not_keep_the_circuit_open(self):
+        async_client = zarinpal.AsyncZarinpalClient(
+            'merchant',
+            request_url=self.gateway.request_url,
+            verify_url=self.gateway.verify_url,
+            backoff_factor=0,
+            verify_retries=0,
+            breaker=zarinpal.CircuitBreaker(failure_threshold=1, reset_timeout=0.2),
+            )
+        self.gateway.fail_next = 1
+        with self.assertRaises(zarinpal.ZarinpalUnavailable):
+            await async_client.verify_payment(1000, 'A1')
+        await asyncio.sleep(0.25)
+
+        # as when the ASGI handler cancels a view whose client went away
+        self.gateway.latency = 1
+        trial = asyncio.ensure_future(async_client.verify_payment(1000, 'A1'))
+        await asyncio.sleep(0.05)
+        trial.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+        with self.assertRaises(zarinpal.ZarinpalUnavailable):
+            await async_client.verify_payment(1000, 'A1')
+
+        self.gateway.latency = 0
+        await asyncio.sleep(0.25)
+        data = await async_client.verify_payment(1000, 'A1')
+        self.assertIn('Status', data)
+
+class AsyncPaymentTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.gateway = StubZarinpalGateway(latency=0.2).start()
+        self.addCleanup(self.gateway.stop)
+        async_client = zarinpal.AsyncZarinpalClient(
+            'merchant',
+            request_url=self.gateway.request_url,
+            verify_url=self.gateway.verify_url,
+            startpay_url=self.gateway.startpay_url,
+            pool_size=100,
+            )
+        patcher = mock.patch.object(zarinpal, 'async_client', async_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = UserFactory()
+        self.auth_header = f'JWT {AccessToken.for_user(user)}'
+        self.order = Order.objects.create(customer=user.customer, total_price=10)
+
+    async def test_pay_and_verify(self):
+        response = await self.async_client.get(
+            reverse('store:order-pay-async', args=[self.order.id]),
+            AUTHORIZATION=self.auth_header,
+            )
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+
+        order = await Order.objects.aget(id=self.order.id)
+        callback_url = self.gateway.calls[0][1]['CallbackURL']
+        response = await self.async_client.get(
+            f"{callback_url}&Authority={order.zarinpal_authority}&Status=OK",
+            AUTHORIZATION=self.auth_header,
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        order = await Order.objects.aget(id=self.order.id)
+        self.assertEqual(order.status, Order.ORDER_STATUS_PAID)
+        self.assertEqual(order.zarinpal_data['Status'], 100)
+
+        attempt = await PaymentAttempt.objects.aget(authority=order.zarinpal_authority)
+        self.assertEqual(attempt.status, PaymentAttempt.PAYMENT_STATUS_SUCCEEDED)
+        self.assertEqual(attempt.ref_id, order.zarinpal_ref_id)
+
+    async def test_retried_async_payment_request_is_replayed(self):
+        responses = [
+            await self.async_client.get(
+                reverse('store:order-pay-async', args=[self.order.id]),
+                AUTHORIZATION=self.auth_header,
+                headers={'Idempotency-Key': 'pay-1'},
+                )
+            for _ in range(2)
+            ]
+
+        self.assertEqual([response.status_code for response in responses], [status.HTTP_302_FOUND] * 2)
+        self.assertEqual(responses[1]['Location'], responses[0]['Location'])
+        self.assertEqual(responses[1]['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(self.gateway.calls), 1)
+        self.assertEqual(await PaymentAttempt.objects.acount(), 1)
+
+    def test_sync_pay_and_verify_without_session(self):
+        client = zarinpal.ZarinpalClient(
+            'merchant',
+            request_url=self.gateway.request_url,
+            verify_url=self.gateway.verify_url,
+            startpay_url=self.gateway.startpay_url,
+            )
+        api_client = APIClient()
+        api_client.credentials(HTTP_AUTHORIZATION=self.auth_header)
+
+        with mock.patch.object(zarinpal, 'client', client):
+            response = api_client.get(reverse('store:order-pay', args=[self.order.id]))
+            self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+
+            authority = PaymentAttempt.objects.get(order=self.order).authority
+            callback_url = self.gateway.calls[0][1]['CallbackURL']
+            response = api_client.get(f'{callback_url}0&Authority={authority}&Status=OK')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            response = api_client.get(f'{callback_url}&Authority={authority}&Status=OK')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertNotIn('sessionid', api_client.cookies)
+        self.assertEqual(Session.objects.count(), 0)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.ORDER_STATUS_PAID)
+
+    async def test_refused_payment_requests_start_no_attempt(self):
+        second_order = await Order.objects.acreate(customer_id=self.order.customer_id, total_price=10)
+        refusal = {'Status': -9, 'Authority': ''}
+
+        with mock.patch.object(zarinpal.client, 'request_payment', return_value=refusal), \
+                mock.patch.object(zarinpal.async_client, 'request_payment', mock.AsyncMock(return_value=refusal)):
+            for order in [self.order, second_order]:
+                response = await sync_to_async(APIClient(HTTP_AUTHORIZATION=self.auth_header).get)(
+                    reverse('store:order-pay', args=[order.id]),
+                    )
+                self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+                response = await self.async_client.get(
+                    reverse('store:order-pay-async', args=[order.id]),
+                    AUTHORIZATION=self.auth_header,
+                    )
+                self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        self.assertFalse(await PaymentAttempt.objects.aexists())
+
+    async def test_canceled_orders_are_not_paid(self):
+        await sync_to_async(Order.objects.filter(id=self.order.id).transition_status)(Order.ORDER_STATUS_CANCELED)
+
+        response = await sync_to_async(APIClient(HTTP_AUTHORIZATION=self.auth_header).get)(
+            reverse('store:order-pay', args=[self.order.id]),
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = await self.async_client.get(
+            reverse('store:order-pay-async', args=[self.order.id]),
+            AUTHORIZATION=self.auth_header,
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.assertEqual(self.gateway.calls, [])
+        self.assertFalse(await PaymentAttempt.objects.aexists())
+
+    async def test_gateway_calls_run_concurrently(self):
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            zarinpal.async_client.verify_payment(1000, f'A{i}') for i in range(50)
+            ])
+
+        # 50 calls of 0.2s each would take 10s one after another.
+        self.assertLess(time.perf_counter() - started, 5)
+
+
+class ReconcilePaymentsTests(StoreTestCase):
+    def test_a_payment_settled_twice_pays_its_order_once(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        order_status_changed.connect(receiver)
+        self.addCleanup(order_status_changed.disconnect, receiver)
+
+        order = Order.objects.create(customer=UserFactory().customer, total_price=10)
+        PaymentAttempt.start(order, amount=500000, data={'Status': 100, 'Authority': 'A' * 36})
+        # the callback and the reconciler both loaded the attempt while the order was unpaid
+        callback_attempt, reconciler_attempt = [
+            PaymentAttempt.objects.select_related('order').get(order=order) for _ in range(2)
+            ]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            callback_attempt.succeed({'Status': 100, 'RefID': 7})
+        with self.captureOnCommitCallbacks(execute=True):
+            reconciler_attempt.succeed({'Status': 101, 'RefID': 7})
+
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0]['from_status'], Order.ORDER_STATUS_UNPAID)
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.zarinpal_data['Status']), (Order.ORDER_STATUS_PAID, 100))
+        self.assertEqual(PaymentAttempt.objects.get().status, PaymentAttempt.PAYMENT_STATUS_SUCCEEDED)
+
+    def test_paid_orders_are_marked_in_bulk(self):
+        customer = UserFactory().customer
+        attempts = [
+            PaymentAttempt.start(
+                Order.objects.create(customer=customer, total_price=10),
+                amount=500000,
+                data={'Status': 100, 'Authority': f'A{i:035d}'},
+                )
+            for i in range(1, 6)
+            ]
+        Order.objects.create(customer=customer, total_price=10)
+        # The first attempt's callback has expired, the second can still complete.
+        PaymentAttempt.objects.filter(id=attempts[0].id).update(datetime_created=timezone.now() - timedelta(days=1))
+        started = timezone.now()
+
+        with StubZarinpalGateway() as gateway:
+            gateway.unpaid_authorities.update([attempts[0].authority, attempts[1].authority])
+            client = zarinpal.ZarinpalClient(
+                'merchant',
+                request_url=gateway.request_url,
+                verify_url=gateway.verify_url,
+                backoff_factor=0,
+                )
+            with self.captureOnCommitCallbacks(execute=True):
+                batches = list(reconcile_payments(client=client, batch_size=2, concurrency=4, rate=0))
+
+        self.assertEqual([batch[1:] for batch in batches], [(2, 0, 1, 0), (2, 2, 0, 0), (1, 1, 0, 0)])
+        self.assertEqual(len(gateway.calls), 5)
+        self.assertEqual(
+            list(Order.objects.filter(status=Order.ORDER_STATUS_PAID).order_by('id').values_list('zarinpal_ref_id', flat=True)),
+            ['3', '4', '5'],
+            )
+        self.assertEqual(
+            dict(PaymentAttempt.objects.values_list('id', 'status')),
+            {
+                attempts[0].id: PaymentAttempt.PAYMENT_STATUS_FAILED,
+                attempts[1].id: PaymentAttempt.PAYMENT_STATUS_WAITING,
+                **{attempt.id: PaymentAttempt.PAYMENT_STATUS_SUCCEEDED for attempt in attempts[2:]},
+                },
+            )
+        self.assertEqual(
+            PaymentAttempt.objects.exclude(id=attempts[1].id).filter(datetime_modified__gte=started).count(),
+            4,
+            )
 
-# Create your tests here.
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework_nested import routers
 
-from store import views
+from store import async_views, views
 
 app_name = 'store'
 
@@ -12,6 +12,7 @@ router.register('categories', views.CategoryViewSet, basename='category')
 router.register('carts', views.CartViewSet, basename='cart')
 router.register('customers', views.CustomerViewSet, basename='customer')
 router.register('orders', views.OrderViewSet, basename='order')
+router.register('archived-orders', views.ArchivedOrderViewSet, basename='archived-order')
 
 products_router = routers.NestedDefaultRouter(
     router,
@@ -52,6 +53,7 @@ order_router.register(
 
 urlpatterns = [
     path('orders/return_to_cart/', views.OrderToCartView.as_view(), name='order_to_cart'),
+    path('orders/export/', views.OrderExportView.as_view(), name='order_export'),
     path('', include(
                 router.urls
                 +
@@ -61,5 +63,9 @@ urlpatterns = [
                 +
                 order_router.urls)),
     path('orders/<int:order_id>/pay/', views.OrderPayView.as_view(), name='order-pay'),
-    path('orders/verify', views.OrderVerifyView.as_view(), name='order_verify')
+    path('orders/verify', views.OrderVerifyView.as_view(), name='order_verify'),
+    # async variants of the payment flow, for ASGI deployments
+    path('orders/<int:order_id>/pay/async/', async_views.AsyncOrderPayView.as_view(), name='order-pay-async'),
+    path('orders/verify/async', async_views.AsyncOrderVerifyView.as_view(), name='order_verify_async'),
+    path('analytics/sales/', views.SalesAnalyticsView.as_view(), name='sales_analytics'),
 ]
@@ -1,9 +1,13 @@
-import json
+from decimal import Decimal
+
 from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Prefetch
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Max, OuterRef, Prefetch, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect
-import requests
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.filters import OrderingFilter, SearchFilter
@@ -11,17 +15,18 @@ from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyM
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.views import APIView
-from config import settings
 
-from store import zarinpal
+from store import analytics, exports, mail, zarinpal
 
-from .filters import ProductFilter
-from .models import Cart, CartItem, Category, Comment, Customer, Order, OrderItem, Product
-from .paginations import DefaultPagination
+from .cache import PURCHASE_HISTORY_TIMEOUT, get_request_customer, get_request_customer_id, purchase_history_key
+from .filters import CustomerFilter, OrderFilter, ProductFilter
+from .idempotency import idempotent
+from .models import ArchivedOrder, ArchivedOrderItem, Cart, CartItem, Category, Comment, Customer, Order, OrderItem, PaymentAttempt, Product
+from .paginations import CustomerDirectoryPagination, DefaultPagination, PurchaseHistoryPagination
 from .permissions import IsAdminOrCreateAndRetrieve, IsAdminOrReadOnly, SendPrivateEmailToCustomerPermission
-from .serializer import AddCartItemSerializer, AdminOrderSerializer, CartItemSerializer, CartSerializer, CategorySerializer, ClientOrderSerializer, CustomerSerializer, OrderCreateSerializer, OrderItemSerializer, OrderToCartSeializer, OrderUpdateSerializer, ProductSerializer, CommentSerializer, UpdateCartItemSerializer
+from .serializer import AddCartItemSerializer, AdminOrderHeaderSerializer, ArchivedOrderSerializer, AdminOrderSerializer, BulkPrivateEmailSerializer, CartItemSerializer, CartSerializer, CategorySerializer, ClientOrderHeaderSerializer, ClientOrderSerializer, CustomerDirectorySerializer, CustomerSerializer, OrderBulkStatusSerializer, OrderCreateSerializer, OrderExportQuerySerializer, OrderItemSerializer, OrderToCartSeializer, OrderUpdateSerializer, PrivateEmailSerializer, ProductSerializer, PurchasedProductSerializer, SalesAnalyticsQuerySerializer, CommentSerializer, UpdateCartItemSerializer
 from .signals import order_created
 
 
@@ -45,7 +50,7 @@ class ProductViewSet(ModelViewSet):
             Product.objects.select_related('category'),
             pk=pk
             )
-        if product.order_items.count() > 0:
+        if product.order_items.exists() or product.archived_order_items.exists():
             return Response({
                 'error':
                     'There is some order items including this product.'
@@ -119,15 +124,63 @@ class CartViewSet(CreateModelMixin,
     lookup_value_regex = '[0-9a-fA-F]{8}\-?[0-9a-fA-F]{4}\-?[0-9a-fA-F]{4}\-?[0-9a-fA-F]{4}\-?[0-9a-fA-F]{12}'
 
 
+def _purchased_products(customer_id):
+    """The products of the customer's paid orders, archived ones included."""
+    def per_product(item_model, aggregate):
+        return Subquery(
+            item_model.objects
+            .filter(product_id=OuterRef('pk'), order__customer_id=customer_id, order__status=Order.ORDER_STATUS_PAID)
+            .values('product_id')
+            .annotate(value=aggregate)
+            .values('value')
+            )
+
+    hot_at = per_product(OrderItem, Max('order__datetime_created'))
+    archived_at = per_product(ArchivedOrderItem, Max('order__datetime_created'))
+    paid_items = {'order__customer_id': customer_id, 'order__status': Order.ORDER_STATUS_PAID}
+    return Product.objects\
+        .filter(
+            Q(id__in=OrderItem.objects.filter(**paid_items).values('product_id'))
+            | Q(id__in=ArchivedOrderItem.objects.filter(**paid_items).values('product_id'))
+            )\
+        .annotate(
+            # GREATEST is NULL on MySQL as soon as one side is.
+            last_purchased_at=Greatest(Coalesce(hot_at, archived_at), Coalesce(archived_at, hot_at)),
+            total_quantity=Coalesce(per_product(OrderItem, Sum('quantity')), 0)
+            + Coalesce(per_product(ArchivedOrderItem, Sum('quantity')), 0),
+            )\
+        .values('last_purchased_at', 'total_quantity', product_id=F('id'), product_name=F('name'))
+
+
 class CustomerViewSet(ModelViewSet):
-    serializer_class = CustomerSerializer
-    queryset = Customer.objects.all()
     permission_classes = [IsAdminUser]
+    filter_backends = [SearchFilter, OrderingFilter, DjangoFilterBackend]
+    # prefix matches, served by the name, email and phone number indexes
+    search_fields = ['^user__first_name', '^user__last_name', '^user__email', '^phone_number']
+    filterset_class = CustomerFilter
+    ordering_fields = ['order_count', 'lifetime_spend', 'average_basket']
+    pagination_class = CustomerDirectoryPagination
+
+    def get_queryset(self):
+        queryset = Customer.objects.select_related('user').all()
+        if self.action == 'list':
+            # Read from the stats table only; customers without paid orders have no row.
+            queryset = queryset.annotate(
+                order_count=Coalesce('stats__order_count', 0),
+                lifetime_spend=Coalesce('stats__lifetime_spend', Value(Decimal(0))),
+                average_basket=Coalesce('stats__average_basket', Value(Decimal(0))),
+                last_order_at=F('stats__last_order_at'),
+                )
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return CustomerDirectorySerializer
+        return CustomerSerializer
 
     @action(detail=False, methods=['GET', 'PUT'], permission_classes=[IsAuthenticated])
     def me(self, request):
-        user_id = request.user.id
-        customer = Customer.objects.get(user_id=user_id)
+        customer = get_request_customer(request)
         if request.method == 'GET':
             serializer = CustomerSerializer(customer)
             return Response(serializer.data)
@@ -137,9 +190,40 @@ class CustomerViewSet(ModelViewSet):
             serializer.save()
             return Response(serializer.data)
 
-    @action(detail=True, permission_classes=[SendPrivateEmailToCustomerPermission])
+    @action(detail=False, url_path='me/purchases', permission_classes=[IsAuthenticated])
+    def purchases(self, request):
+        customer_id = get_request_customer_id(request)
+        paginator = PurchaseHistoryPagination()
+        cache_key = purchase_history_key(customer_id, request.query_params.get(paginator.cursor_query_param))
+
+        data = cache.get(cache_key)
+        if data is None:
+            queryset = _purchased_products(customer_id)
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            serializer = PurchasedProductSerializer(page, many=True)
+            data = paginator.get_paginated_response(serializer.data).data
+            cache.set(cache_key, data, PURCHASE_HISTORY_TIMEOUT)
+
+        return Response(data)
+
+    @action(detail=True, methods=['POST'], permission_classes=[SendPrivateEmailToCustomerPermission])
     def send_private_email(self, request, pk):
-        return Response(f'Sending private email to customer {pk=}')
+        serializer = PrivateEmailSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        customer = get_object_or_404(Customer, pk=pk)
+        [email] = mail.queue_private_emails([customer.id], **serializer.validated_data)
+        return Response({'id': email.id, 'queued': 1}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['POST'], permission_classes=[SendPrivateEmailToCustomerPermission])
+    def send_private_emails(self, request):
+        serializer = BulkPrivateEmailSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        emails = mail.queue_private_emails(
+            serializer.validated_data['customer_ids'],
+            subject=serializer.validated_data['subject'],
+            body=serializer.validated_data['body'],
+            )
+        return Response({'queued': len(emails)}, status=status.HTTP_202_ACCEPTED)
 
 
 class OrderItemViewSet(ModelViewSet):
@@ -159,32 +243,45 @@ class OrderItemViewSet(ModelViewSet):
 
         if user.is_staff:
             return queryset
-        return queryset.filter(order__customer__id=user.id)
+        return queryset.filter(order__customer_id=get_request_customer_id(self.request))
 
 
 class OrderViewSet(ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete', 'option', 'head']
     # permission_classes = [IsAuthenticated]
+    filter_backends = [OrderingFilter, DjangoFilterBackend]
+    filterset_class = OrderFilter
+    ordering_fields = ['datetime_created', 'total_price']
+    ordering = ['-datetime_created']
+    pagination_class = DefaultPagination
 
     def get_permissions(self):
-        if self.request.method in ['DELETE', 'PATCH']:
+        if self.request.method in ['DELETE', 'PATCH'] or self.action == 'bulk_status':
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
+    def include_items(self):
+        # ?items=false returns order headers only and skips the items prefetch
+        return self.request.query_params.get('items', 'true').lower() not in ['0', 'false', 'no']
+
     def get_queryset(self):
         user = self.request.user
-        queryset = Order.objects.select_related('customer__user')\
-            .prefetch_related(
+        queryset = Order.objects.select_related('customer__user').all()
+        if self.include_items():
+            queryset = queryset.prefetch_related(
                 Prefetch(
                     'items',
                     queryset=OrderItem.objects.select_related('product')
                 )
-            ).all()
+            )
         if user.is_staff:
             return queryset
-        return queryset.filter(customer__user=user.id)
+        return queryset.filter(customer_id=get_request_customer_id(self.request))
 
     def get_serializer_class(self):
+        if self.action == 'bulk_status':
+            return OrderBulkStatusSerializer
+
         if self.request.method == 'POST':
             return OrderCreateSerializer
 
@@ -194,26 +291,46 @@ class OrderViewSet(ModelViewSet):
         user = self.request.user
 
         if user.is_staff:
-            return AdminOrderSerializer
+            if self.include_items():
+                return AdminOrderSerializer
+            return AdminOrderHeaderSerializer
 
-        return ClientOrderSerializer
+        if self.include_items():
+            return ClientOrderSerializer
+        return ClientOrderHeaderSerializer
 
     def get_serializer_context(self):
         return {'user_id': self.request.user.id}
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         create_order_serializer = OrderCreateSerializer(
             data=request.data,
-            context={'user_id': self.request.user.id}
+            context={'customer_id': get_request_customer_id(request)}
             )
         create_order_serializer.is_valid(raise_exception=True)
-        created_order = create_order_serializer.save()
-        # send signal order_created with send_robust.
-        order_created.send_robust(sender=self.__class__, order=created_order)
+        with transaction.atomic():
+            created_order = create_order_serializer.save()
+            # Receivers enqueue their tasks in the checkout transaction, so an
+            # order is never committed without them.
+            order_created.send(sender=self.__class__, order=created_order)
 
         serializer = ClientOrderSerializer(created_order)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=['POST'])
+    def bulk_status(self, request):
+        serializer = OrderBulkStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        changed = serializer.save()
+
+        updated_count = sum(len(order_ids) for order_ids in changed.values())
+        return Response({
+            'updated': updated_count,
+            'skipped': len(set(serializer.validated_data['order_ids'])) - updated_count,
+            'transitions': {from_status: len(order_ids) for from_status, order_ids in changed.items()},
+            })
+
     def destroy(self, request, pk):
         order = Order.objects.prefetch_related('items').get(pk=pk)
 
@@ -229,6 +346,26 @@ class OrderViewSet(ModelViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class ArchivedOrderViewSet(ReadOnlyModelViewSet):
+    serializer_class = ArchivedOrderSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = DefaultPagination
+
+    def get_queryset(self):
+        user = self.request.user
+        queryset = ArchivedOrder.objects\
+            .prefetch_related(
+                Prefetch(
+                    'items',
+                    queryset=ArchivedOrderItem.objects.select_related('product')
+                )
+            )\
+            .order_by('-datetime_created')
+        if user.is_staff:
+            return queryset
+        return queryset.filter(customer_id=get_request_customer_id(self.request))
+
+
 class OrderToCartView(APIView):
     http_method_names = ['get', 'post']
     permission_classes = [IsAuthenticated]
@@ -242,6 +379,7 @@ class OrderToCartView(APIView):
         order_to_cart_serializer.is_valid(raise_exception=True)
         new_cart = order_to_cart_serializer.save()
 
+        new_cart = Cart.objects.prefetch_related('items__product').get(pk=new_cart.pk)
         serializer = CartSerializer(new_cart)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -250,46 +388,30 @@ class OrderPayView(APIView):
     http_method_names = ['get', 'option', 'head']
     permission_classes = [IsAuthenticated]
 
+    @idempotent
     def get(self, request, order_id):
         order = get_object_or_404(Order, id=order_id)
 
-        if order.status == 'p':
+        if order.status == Order.ORDER_STATUS_PAID:
             return Response('This order has been paid!')
+        if order.status != Order.ORDER_STATUS_UNPAID:
+            return Response({'error': 'This order has been canceled and can not be paid.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        amount = zarinpal.payment_amount(order)
+        try:
+            data = zarinpal.client.request_payment(
+                amount=amount,
+                description='TechnoShop',
+                callback_url=zarinpal.callback_url(request.build_absolute_uri(reverse('store:order_verify')), order),
+                )
+        except zarinpal.ZarinpalError:
+            return Response({'error': 'Zarinpal is not available'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        request.session['order_pay'] = {
-            'order_id': order.id,
-        }
-
-        request.session['order_id'] = {
-            'order_id': int(order_id),
-        }
-
-        req_data = {
-            "MerchantID": settings.ZARINPALL_MERCHANT_ID,
-            "Amount": int(order.get_total_price() * 50000),
-            "Description": 'TechnoShop',
-            "Phone": '',
-            "CallbackURL": request.build_absolute_uri(reverse('store:order_verify')),
-        }
-
-        request_header = {
-            "accept": "application/json",
-            "content-type": "application/json"
-        }
-        res = requests.post(zarinpal.ZP_API_REQUEST, data=json.dumps(req_data), headers=request_header)
-        print(res)
-        # print(res.json()['data'])
-
-        data = res.json()
-        print(data)
-        authority = data['Authority']
-        order.zarinpal_authority = authority
-        order.save()
-
-        if 'errors' not in data or len(data['errors']) == 0:
-            return redirect(zarinpal.ZP_API_STARTPAY.format(sandbox=zarinpal.sandbox, authority=authority))
+        # Refusals (e.g. Status -9) come back without errors but with no authority.
+        if data.get('Status') == 100 and data.get('Authority'):
+            attempt = PaymentAttempt.start(order, amount, data)
+            return redirect(zarinpal.client.start_pay_url(attempt.authority))
         else:
-            print(data['errors'])
             # Need to ckeak for order.return_products_to_cart
             return Response({'error': 'Error from zarinpal'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
@@ -302,49 +424,97 @@ class OrderVerifyView(APIView):
         payment_authority = request.GET.get('Authority')
         payment_status = request.GET.get('Status')
 
-        order = get_object_or_404(Order, zarinpal_authority=payment_authority)
+        order_id = zarinpal.callback_order_id(request.GET)
+        if order_id is None:
+            return Response({'error': 'The payment callback is invalid or has expired.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        if payment_status == 'OK':
-            request_header = {
-                "accept": "application/json",
-                "content-type": "application/json",
-            }
-
-            req_data = {
-                'MerchantID': settings.ZARINPALL_MERCHANT_ID,
-                'Amount': int(order.get_total_price() * 50000),
-                'Authority': payment_authority,
-            }
-
-            res = requests.post(
-                    zarinpal.ZP_API_VERIFY,
-                    data=json.dumps(req_data),
-                    headers=request_header,
+        attempt = get_object_or_404(
+            PaymentAttempt.objects.select_related('order'),
+            authority=payment_authority,
+            order_id=order_id,
+            )
 
-                )
-            if 'errors' not in res.json():
-                data = res.json()
-                payment_code = data['Status']
-
-                if payment_code == 100:
-                    order.status = 'p'
-                    order.zarinpal_ref_id = data['RefID']
-                    order.zarinpal_data = data
-                    order.save()
-                    return Response({'success': 'Your payment has been successfully completed!'}, status=status.HTTP_200_OK)
-                    # Need to ckeak for order.return_products_to_cart
-                elif payment_code == 101:
-                    return Response({'success': 'Your payment has been successfully completed.'
-                                    ' Of course, this transaction has already been registered!'}, status=status.HTTP_200_OK)
-
-                else:
-                    # Need to ckeak for order.return_products_to_cart
-                    error_code = res.json().get('errors', {}).get('code')
-                    # error_message = res.json()['errors']['message']
-                    error_message = res.json().get('errors', {}).get('message')
-                    return Response({'error': f'The transaction was unsuccessful! {error_message} {error_code} '}, status=status.HTTP_400_BAD_REQUEST)
+        if payment_status == 'OK':
+            try:
+                data = zarinpal.client.verify_payment(
+                    amount=attempt.amount,
+                    authority=payment_authority,
+                    )
+            except zarinpal.ZarinpalError:
+                return Response({'error': 'Zarinpal is not available'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+            payment_code = data.get('Status')
+
+            if 'errors' not in data and payment_code == 100:
+                attempt.succeed(data)
+                return Response({'success': 'Your payment has been successfully completed!'}, status=status.HTTP_200_OK)
+                # Need to ckeak for order.return_products_to_cart
+            elif 'errors' not in data and payment_code == 101:
+                return Response({'success': 'Your payment has been successfully completed.'
+                                ' Of course, this transaction has already been registered!'}, status=status.HTTP_200_OK)
+
+            else:
+                # Need to ckeak for order.return_products_to_cart
+                attempt.fail(data)
+                error_code = data.get('errors', {}).get('code')
+                error_message = data.get('errors', {}).get('message')
+                return Response({'error': f'The transaction was unsuccessful! {error_message} {error_code} '}, status=status.HTTP_400_BAD_REQUEST)
 
         else:
 
             # Need to ckeak for order.return_products_to_cart
-            return Response({'error': 'The transaction was unsuccessful or canceled by user !'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
\ No newline at end of file
+            return Response({'error': 'The transaction was unsuccessful or canceled by user !'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+class SalesAnalyticsView(APIView):
+    http_method_names = ['get', 'option', 'head']
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        query_serializer = SalesAnalyticsQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+        query = query_serializer.validated_data
+
+        if query['group_by'] == SalesAnalyticsQuerySerializer.GROUP_BY_DAY:
+            results = analytics.sales_time_series(
+                query['start'],
+                query['end'],
+                product_id=query.get('product'),
+                category_id=query.get('category'),
+                )
+        else:
+            results = analytics.top_sellers(
+                query['start'],
+                query['end'],
+                group_by=query['group_by'],
+                metric=query['metric'],
+                limit=query['limit'],
+                category_id=query.get('category'),
+                )
+
+        return Response({
+            'start': query['start'],
+            'end': query['end'],
+            'group_by': query['group_by'],
+            'results': list(results),
+            })
+
+
+class OrderExportView(APIView):
+    http_method_names = ['get', 'option', 'head']
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        query_serializer = OrderExportQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+        query = query_serializer.validated_data
+
+        rows = exports.export_rows(
+            start=query.get('start'),
+            end=query.get('end'),
+            status=query.get('status'),
+            )
+        render, content_type = exports.EXPORT_FORMATS[query['file_format']]
+
+        response = StreamingHttpResponse(render(rows), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="orders.{query["file_format"]}"'
+        return response
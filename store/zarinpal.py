@@ -1,4 +1,14 @@
+import asyncio
+import threading
+import time
+import weakref
+
+import httpx
+import requests
 from django.conf import settings
+from django.core import signing
+from django.utils.http import urlencode
+from requests.adapters import HTTPAdapter
 
 if settings.SANDBOX:
     sandbox = 'sandbox'
@@ -9,3 +19,240 @@ ZP_API_REQUEST = f"https://{sandbox}.zarinpal.com/pg/rest/WebGate/PaymentRequest
 ZP_API_VERIFY = f"https://{sandbox}.zarinpal.com/pg/rest/WebGate/PaymentVerification.json"
 ZP_API_STARTPAY = "https://{sandbox}.zarinpal.com/pg/StartPay/{authority}"
 CallbackURL = 'http://127.0.0.1:8000/orders/verify'
+
+
+CALLBACK_STATE_PARAM = 'state'
+CALLBACK_STATE_SALT = 'store.zarinpal.callback'
+
+
+def payment_amount(order):
+    return int(order.total_price * 50000)
+
+
+def callback_url(url, order):
+    """
+    Add a signed, expiring reference to `order` to the callback URL.
+
+    Zarinpal appends Authority and Status to it, so the verify view gets
+    back which order it is paying without any server-side session.
+    """
+    state = signing.TimestampSigner(salt=CALLBACK_STATE_SALT).sign(str(order.id))
+    return f'{url}?{urlencode({CALLBACK_STATE_PARAM: state})}'
+
+
+def callback_order_id(query_params):
+    """Return the order id signed into the callback URL, or None if invalid or expired."""
+    state = query_params.get(CALLBACK_STATE_PARAM)
+    if not state:
+        return None
+    try:
+        return int(signing.TimestampSigner(salt=CALLBACK_STATE_SALT).unsign(
+            state,
+            max_age=settings.ZARINPAL_CALLBACK_MAX_AGE,
+            ))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+class ZarinpalError(Exception):
+    pass
+
+
+class ZarinpalUnavailable(ZarinpalError):
+    """The gateway timed out, failed, or the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fail fast after `failure_threshold` consecutive gateway failures.
+
+    Once open, calls are refused for `reset_timeout` seconds, then a single
+    trial call is let through; its outcome closes or re-opens the circuit.
+    A trial that never reports back, because its caller was cancelled or
+    raised something unexpected, is given up after another `reset_timeout`.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_started_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            if self._trial_started_at is not None and now - self._trial_started_at < self.reset_timeout:
+                return False
+            self._trial_started_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_started_at = None
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class ZarinpalClient:
+    """
+    Zarinpal REST client sharing one pooled session between requests.
+
+    Every call is bounded by `timeout` (connect, read). Verification is
+    idempotent on the gateway side, so it is retried `verify_retries` times
+    with exponential backoff; payment requests are never retried.
+    """
+    def __init__(
+            self,
+            merchant_id,
+            request_url=ZP_API_REQUEST,
+            verify_url=ZP_API_VERIFY,
+            startpay_url=ZP_API_STARTPAY,
+            timeout=(3.05, 10),
+            verify_retries=2,
+            backoff_factor=0.5,
+            pool_size=20,
+            breaker=None,
+            ):
+        self.merchant_id = merchant_id
+        self.request_url = request_url
+        self.verify_url = verify_url
+        self.startpay_url = startpay_url
+        self.timeout = timeout
+        self.verify_retries = verify_retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            "accept": "application/json",
+            "content-type": "application/json",
+        })
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _post(self, url, payload, retries=0):
+        for attempt in range(retries + 1):
+            if not self.breaker.allow():
+                raise ZarinpalUnavailable('Zarinpal circuit is open.')
+
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                if response.status_code >= 500:
+                    raise ZarinpalUnavailable(f'Zarinpal answered {response.status_code}.')
+                data = response.json()
+            except (requests.RequestException, ValueError, ZarinpalUnavailable) as e:
+                self.breaker.record_failure()
+                if attempt == retries:
+                    raise ZarinpalUnavailable(str(e)) from e
+                time.sleep(self.backoff_factor * 2 ** attempt)
+            else:
+                self.breaker.record_success()
+                return data
+
+    def request_payment(self, amount, description, callback_url, phone=''):
+        return self._post(
+            self.request_url,
+            self._payment_request_payload(amount, description, callback_url, phone),
+            )
+
+    def verify_payment(self, amount, authority):
+        return self._post(
+            self.verify_url,
+            self._verify_payload(amount, authority),
+            retries=self.verify_retries,
+            )
+
+    def _payment_request_payload(self, amount, description, callback_url, phone):
+        return {
+            "MerchantID": self.merchant_id,
+            "Amount": amount,
+            "Description": description,
+            "Phone": phone,
+            "CallbackURL": callback_url,
+        }
+
+    def _verify_payload(self, amount, authority):
+        return {
+            'MerchantID': self.merchant_id,
+            'Amount': amount,
+            'Authority': authority,
+        }
+
+    def start_pay_url(self, authority):
+        return self.startpay_url.format(sandbox=sandbox, authority=authority)
+
+
+class AsyncZarinpalClient(ZarinpalClient):
+    """
+    The same client for async views, on a pooled httpx.AsyncClient.
+
+    httpx clients are bound to the event loop they first run on, so one
+    is kept per loop.
+    """
+    def __init__(self, merchant_id, **kwargs):
+        super().__init__(merchant_id, **kwargs)
+        self._http_clients = weakref.WeakKeyDictionary()
+
+    def _http_client(self):
+        loop = asyncio.get_running_loop()
+        http_client = self._http_clients.get(loop)
+        if http_client is None:
+            connect_timeout, read_timeout = self.timeout
+            http_client = httpx.AsyncClient(
+                headers=dict(self.session.headers),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                )
+            self._http_clients[loop] = http_client
+        return http_client
+
+    async def _post(self, url, payload, retries=0):
+        for attempt in range(retries + 1):
+            if not self.breaker.allow():
+                raise ZarinpalUnavailable('Zarinpal circuit is open.')
+
+            try:
+                response = await self._http_client().post(url, json=payload)
+                if response.status_code >= 500:
+                    raise ZarinpalUnavailable(f'Zarinpal answered {response.status_code}.')
+                data = response.json()
+            except (httpx.HTTPError, ValueError, ZarinpalUnavailable) as e:
+                self.breaker.record_failure()
+                if attempt == retries:
+                    raise ZarinpalUnavailable(str(e)) from e
+                await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+            else:
+                self.breaker.record_success()
+                return data
+
+    async def request_payment(self, amount, description, callback_url, phone=''):
+        return await self._post(
+            self.request_url,
+            self._payment_request_payload(amount, description, callback_url, phone),
+            )
+
+    async def verify_payment(self, amount, authority):
+        return await self._post(
+            self.verify_url,
+            self._verify_payload(amount, authority),
+            retries=self.verify_retries,
+            )
+
+
+client = ZarinpalClient(settings.ZARINPALL_MERCHANT_ID)
+# One event loop keeps many gateway calls in flight, so allow a larger pool.
+async_client = AsyncZarinpalClient(settings.ZARINPALL_MERCHANT_ID, pool_size=500)
@@ -0,0 +1,129 @@
+"""
+A local stand-in for the Zarinpal REST gateway, for tests and load tests.
+
+    python -m store.zarinpal_stub 8765 --latency 0.2
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # load tests open many connections at once
+    request_queue_size = 1024
+
+
+class StubZarinpalGateway:
+    """
+    Serve PaymentRequest.json and PaymentVerification.json on localhost.
+
+    `latency` delays every answer, `fail_next` makes that many following
+    calls answer 500, authorities in `unpaid_authorities` fail verification
+    and `calls` records (path, payload) of every call.
+    """
+    def __init__(self, port=0, latency=0):
+        self.latency = latency
+        self.fail_next = 0
+        self.calls = []
+        self.verified_authorities = set()
+        self.unpaid_authorities = set()
+        self._authorities = count(1)
+        self._lock = threading.Lock()
+        self.server = _Server(('127.0.0.1', port), self._handler_class())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    @property
+    def request_url(self):
+        return f'{self.base_url}/pg/rest/WebGate/PaymentRequest.json'
+
+    @property
+    def verify_url(self):
+        return f'{self.base_url}/pg/rest/WebGate/PaymentVerification.json'
+
+    @property
+    def startpay_url(self):
+        return self.base_url + '/pg/StartPay/{authority}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _answer(self, path, payload):
+        with self._lock:
+            if self.fail_next:
+                self.fail_next -= 1
+                return 500, {'errors': {'code': -1, 'message': 'stub failure'}}
+
+            if path.endswith('PaymentRequest.json'):
+                return 200, {'Status': 100, 'Authority': f'A{next(self._authorities):035d}'}
+
+            if path.endswith('PaymentVerification.json'):
+                authority = payload.get('Authority')
+                if authority in self.unpaid_authorities:
+                    return 200, {'Status': -21}
+                if authority in self.verified_authorities:
+                    return 200, {'Status': 101, 'RefID': int(authority[1:])}
+                self.verified_authorities.add(authority)
+                return 200, {'Status': 100, 'RefID': int(authority[1:])}
+
+        return 404, {'errors': {'code': -404, 'message': 'not found'}}
+
+    def _handler_class(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                with gateway._lock:
+                    gateway.calls.append((self.path, payload))
+                if gateway.latency:
+                    time.sleep(gateway.latency)
+
+                status, body = gateway._answer(self.path, payload)
+                content = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting, e.g. on a read timeout.
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('port', type=int, nargs='?', default=8765)
+    parser.add_argument('--latency', type=float, default=0)
+    args = parser.parse_args()
+
+    gateway = StubZarinpalGateway(port=args.port, latency=args.latency)
+    print(f'Stub Zarinpal gateway listening on {gateway.base_url}')
+    gateway.server.serve_forever()